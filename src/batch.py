@@ -0,0 +1,175 @@
+import os
+import sys
+import time
+import dataclasses
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cache
+import engine
+import exiftool
+
+_engine = None
+
+
+def find_masks(directory):
+    res = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith('_mask.png'):
+                res.append(os.path.join(root, name))
+    return res
+
+
+def get_workers(conf, jobs=None):
+    if conf.device.startswith('cuda') and ':' not in conf.device:
+        import torch
+        n = max(torch.cuda.device_count(), 1)
+        devices = [f'cuda:{i}' for i in range(n)]
+    else:
+        devices = [conf.device]
+    if jobs is None:
+        if conf.device == 'cpu':
+            jobs = max(1, (os.cpu_count() or 1) // 4)
+        else:
+            jobs = len(devices)
+    jobs = max(1, jobs)
+    return [devices[i % len(devices)] for i in range(jobs)]
+
+
+def _init_worker(conf, devices, threads):
+    global _engine
+    import torch
+    if threads:
+        torch.set_num_threads(threads)
+    conf = dataclasses.replace(conf, device=devices.get())
+    _engine = engine.AIMaskingEngine(conf)
+
+
+def check_masks(conf, src, items, force, checksums):
+    # the status of the masks of one source image that do not need to be
+    # regenerated, and the ones that do
+    if not os.path.exists(src):
+        return [(fn, 'missing source image') for (fn, _) in items], []
+    if force:
+        outdated = items
+    else:
+        sha256sum = checksums.checksum(src)
+        outdated = [(fn, info) for (fn, info) in items
+                    if info.get('model') != conf.model
+                    or info['sha256sum'] != sha256sum]
+    names = set(fn for (fn, _) in outdated)
+    status = [(fn, 'up to date') for (fn, _) in items if fn not in names]
+    todo = []
+    # masks propagated from other frames by sequence mode have no points to
+    # regenerate them from, nor do empty masks
+    for fn, info in outdated:
+        if info.get('propagated'):
+            status.append((fn, 'needs re-propagation'))
+        elif not info['points']:
+            status.append((fn, 'no points'))
+        else:
+            todo.append((fn, info))
+    return status, todo
+
+
+def _regenerate(items):
+    # items are the (mask_file, info) pairs of the masks of one source
+    # image, which is encoded only once; their masks are decoded together
+    start = time.perf_counter()
+    src = items[0][1]['image']
+    _engine.reset(True)
+    _engine.open_image(src)
+    _engine.set_layers([(info.get('layer', _engine.default_layer),
+                         info['points'], info['labels'])
+                        for (_, info) in items])
+    for (fn, info), layer in zip(items, _engine.layers):
+        _engine.save_layers([(layer, fn)], info.get('layers'))
+    return ([(fn, 'regenerated') for (fn, _) in items],
+            time.perf_counter() - start)
+
+
+def main(conf, directory, jobs=None, force=False):
+    et = exiftool.ExifTool.from_config(conf)
+    if et is None:
+        print('exiftool is required for batch mode')
+        return 1
+    masks = find_masks(directory)
+    todo = []
+    chunk = 100
+    for i in range(0, len(masks), chunk):
+        names = masks[i:i+chunk]
+        for fn, info in zip(names, engine.read_mask_data(et, names)):
+            if info is None:
+                print(f'{fn}: no mask data, skipped')
+            else:
+                todo.append((fn, info))
+    et.close()
+    if not todo:
+        print(f'no masks to process in {directory}')
+        return 0
+
+    groups = {}
+    for fn, info in todo:
+        groups.setdefault(info['image'], []).append((fn, info))
+
+    # the masks are checked here, so that the workers (and their models)
+    # are only started for those that need to be regenerated
+    counts = {}
+    done = 0
+    start = time.perf_counter()
+
+    def report(msgs):
+        nonlocal done
+        for fn, msg in msgs:
+            done += 1
+            rate = done / (time.perf_counter() - start)
+            print(f'[{done}/{len(todo)}] {fn}: {msg}, {rate:.2f} masks/s')
+        sys.stdout.flush()
+
+    checksums = cache.ChecksumIndex.from_config(conf)
+    outdated = []
+    for src, items in groups.items():
+        status, items = check_masks(conf, src, items, force, checksums)
+        for fn, s in status:
+            counts[s] = counts.get(s, 0) + 1
+        report(status)
+        if items:
+            outdated.append(items)
+
+    failed = 0
+    if outdated:
+        workers = get_workers(conf, jobs)[:len(outdated)]
+        threads = max(1, (os.cpu_count() or 1) // len(workers))
+        print(f'regenerating {sum(len(i) for i in outdated)} masks of '
+              f'{len(outdated)} images with {len(workers)} workers '
+              f'({", ".join(sorted(set(workers)))})')
+        ctx = multiprocessing.get_context('spawn')
+        devices = ctx.Manager().Queue()
+        for d in workers:
+            devices.put(d)
+        with ProcessPoolExecutor(max_workers=len(workers), mp_context=ctx,
+                                 initializer=_init_worker,
+                                 initargs=(conf, devices, threads)) as pool:
+            futures = {pool.submit(_regenerate, items): items
+                       for items in outdated}
+            for f in as_completed(futures):
+                items = futures[f]
+                try:
+                    res, elapsed = f.result()
+                    msgs = []
+                    for fn, status in res:
+                        counts[status] = counts.get(status, 0) + 1
+                        msgs.append((fn, f'{status} ({elapsed:.2f} s)'))
+                except Exception as e:
+                    failed += len(items)
+                    msgs = [(fn, f'error: {e}') for (fn, _) in items]
+                report(msgs)
+    elapsed = time.perf_counter() - start
+    summary = ', '.join(f'{n} {s}' for (s, n) in sorted(counts.items()))
+    if failed:
+        summary += f', {failed} failed'
+    print(f'processed {len(todo)} masks in {elapsed:.1f} s '
+          f'({len(todo) / elapsed:.2f} masks/s): {summary}')
+    return 1 if failed else 0
@@ -0,0 +1,412 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import dataclasses
+import tracemalloc
+
+import numpy as np
+from PIL import Image, ImageCms
+
+import config
+import engine
+import inference
+
+
+class FakePredictor:
+    # deterministic stand-in for SAM2ImagePredictor: the "embedding" is a
+    # thumbnail of the image, and masks are discs around the points,
+    # computed at the 256x256 logits resolution and upsampled to the
+    # image size like SAM2 does
+    def __init__(self):
+        self.device = 'cpu'
+        self.reset_predictor()
+
+    def reset_predictor(self):
+        self._is_image_set = False
+        self._features = None
+        self._orig_hw = None
+
+    def set_image(self, image):
+        self.reset_predictor()
+        h, w = image.shape[:2]
+        self._orig_hw = [(h, w)]
+        thumb = np.ascontiguousarray(image[::max(1, h // 64),
+                                           ::max(1, w // 64)])
+        self._features = {'image_embed': thumb, 'high_res_feats': []}
+        self._is_image_set = True
+
+    def predict(self, point_coords, point_labels, mask_input=None,
+                multimask_output=True, **kwds):
+        # batched prompts (BxNx2) give Bx1xHxW results, padded with -1
+        # labels, like SAM2
+        coords = np.asarray(point_coords, dtype=np.float32)
+        labels = np.asarray(point_labels)
+        if coords.ndim == 2:
+            coords, labels = coords[None], labels[None]
+        h, w = self._orig_hw[0]
+        res = 256
+        yy, xx = np.ogrid[:res, :res]
+        radius = res / 8
+        logits = np.empty((len(coords), 1, res, res), dtype=np.float32)
+        for i in range(len(coords)):
+            low = np.zeros((res, res), dtype=bool)
+            for (x, y), label in zip(coords[i], labels[i]):
+                if label < 0:
+                    continue
+                disc = (xx - x * res / w) ** 2 + (yy - y * res / h) ** 2 \
+                    <= radius ** 2
+                low = (low | disc) if label else (low & ~disc)
+            logits[i, 0] = np.where(low, 10.0, -10.0)
+        iy = np.arange(h) * res // h
+        ix = np.arange(w) * res // w
+        masks = (logits[:, :, iy[:, None], ix[None, :]] > 0).astype(
+            np.float32)
+        scores = np.ones((len(coords), 1), dtype=np.float32)
+        if len(coords) == 1:
+            return masks[0], scores[0], logits[0]
+        return masks, scores, logits
+
+# end of class FakePredictor
+
+
+class FakeExifTool:
+    def __init__(self):
+        self.tags = {}
+
+    def read_tags(self, filenames, tags):
+        return [dict(self.tags.get(os.path.abspath(fn), {}))
+                for fn in filenames]
+
+    def write_tags(self, items):
+        for filename, tags in items:
+            self.tags.setdefault(os.path.abspath(filename), {}).update(tags)
+        return ['' for _ in items]
+
+    def close(self):
+        pass
+
+# end of class FakeExifTool
+
+
+def make_engine(conf):
+    eng = engine.AIMaskingEngine(conf, load_model=False)
+    eng.predictor = FakePredictor()
+    eng.prefetch_predictor = FakePredictor()
+    eng.model_ready.set()
+    eng.exiftool = FakeExifTool()
+    return eng
+
+
+def make_image(filename, megapixels, seed=0):
+    w = int(round((megapixels * 1e6 * 1.5) ** 0.5))
+    h = int(round(megapixels * 1e6 / w))
+    rng = np.random.default_rng(seed)
+    # smooth gradients plus some noise, so that the image compresses like
+    # a photo rather than like pure noise
+    x = np.linspace(0, 240, w, dtype=np.float32)
+    img = np.empty((h, w, 3), dtype=np.uint8)
+    noise = rng.integers(0, 16, size=(min(h, 256), w, 3), dtype=np.uint8)
+    for y in range(0, h, 256):
+        rows = min(256, h - y)
+        t = np.linspace(y, y + rows, rows, endpoint=False,
+                        dtype=np.float32)[:, None] / h * 240
+        img[y:y+rows, :, 0] = (x[None, :] * 0.7 + t * 0.3)
+        img[y:y+rows, :, 1] = (240 - x[None, :]) * 0.5 + t * 0.5
+        img[y:y+rows, :, 2] = t
+        img[y:y+rows] += noise[:rows]
+    Image.fromarray(img).save(filename)
+    return filename, (w, h)
+
+
+class MemoryTracker:
+    # peak of the memory allocated through Python (including NumPy arrays,
+    # but not PIL or torch buffers) while the tracker is active
+    def __init__(self):
+        self.peak = 0
+        self.started = False
+
+    def __enter__(self):
+        self.started = not tracemalloc.is_tracing()
+        if self.started:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        return self
+
+    def __exit__(self, *args):
+        self.peak = tracemalloc.get_traced_memory()[1]
+        if self.started:
+            tracemalloc.stop()
+
+# end of class MemoryTracker
+
+
+def measure(func, repeat, setup=None):
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup(i)
+        start = time.perf_counter()
+        func(i)
+        times.append(time.perf_counter() - start)
+    if setup is not None:
+        setup(0)
+    with MemoryTracker() as mem:
+        func(0)
+    t = np.array(times) * 1000
+    return {
+        'n': repeat,
+        'mean_ms': float(t.mean()),
+        'min_ms': float(t.min()),
+        'p50_ms': float(np.percentile(t, 50)),
+        'p90_ms': float(np.percentile(t, 90)),
+        'p99_ms': float(np.percentile(t, 99)),
+        'max_ms': float(t.max()),
+        'peak_memory_mb': mem.peak / (1 << 20),
+    }
+
+
+def bench_engine(conf, filename, size, repeat):
+    eng = make_engine(conf)
+    w, h = size
+    rng = np.random.default_rng(1)
+    points = [(int(x), int(y)) for (x, y) in
+              zip(rng.integers(0, w, 4096), rng.integers(0, h, 4096))]
+    res = {}
+    nload = max(1, repeat // 4)
+    res['load_image'] = measure(lambda i: eng.load_image(filename), nload)
+
+    eng.load_image(filename)
+    res['make_overlay'] = measure(lambda i: eng.make_overlay(eng.image),
+                                  nload)
+    res['to_display'] = measure(lambda i: eng.to_display(eng.image), repeat)
+    eng.overlay = eng.make_overlay(eng.image)
+
+    def reset(i):
+        eng.reset(False)
+        eng.results.clear()
+    def add(i):
+        eng.add_point(points[i], True)
+    res['predict'] = measure(add, repeat, reset)
+
+    def fill(i):
+        reset(i)
+        for p in points[-3:]:
+            eng.add_point(p, True)
+    def undo(i):
+        eng.undo_last()
+    res['undo_last'] = measure(undo, repeat, fill)
+
+    out = os.path.join(os.path.dirname(filename), 'bench_mask.png')
+    res['save_mask'] = measure(lambda i: eng.save_mask(out), nload)
+    return eng, res
+
+
+INFERENCE_VARIANTS = {
+    'baseline': {},
+    'inference_mode': {'inference_mode': True},
+    'bf16': {'inference_mode': True, 'autocast_bf16': True},
+    'int8': {'inference_mode': True, 'quantize': True},
+    'compile': {'inference_mode': True, 'compile_model': True},
+}
+
+
+def bench_inference(conf, filename, repeat, variants):
+    # encoder and decoder latency of the real model, with each set of
+    # inference options, on the same image
+    base = dataclasses.replace(conf, inference_mode=False,
+                               autocast_bf16=False, quantize=False,
+                               compile_model=False, embedding_cache_size=0)
+    img = np.array(Image.open(filename).convert('RGB'))
+    h, w = img.shape[:2]
+    results = {}
+    for name in variants:
+        vconf = dataclasses.replace(base, **INFERENCE_VARIANTS[name])
+        eng = engine.AIMaskingEngine(vconf)
+        layer = engine.MaskLayer('bench', [(w // 2, h // 2)], [1])
+        def encode(i):
+            eng.encode(eng.predictor, img, filename)
+        def decode(i):
+            layer.mask_input = None
+            eng.decode([layer])
+        res = {'encoder': measure(encode, repeat)}
+        res['decoder'] = measure(decode, repeat)
+        enabled = eng.inference.enabled()
+        if enabled != inference.InferenceOptions(vconf).enabled():
+            name += ' (fallback: ' + (', '.join(enabled) or 'none') + ')'
+        results[name] = res
+        del eng
+    return results
+
+
+def bench_panel(eng, repeat, panel_size=(1200, 800)):
+    # times the ImagePanel methods that turn the displayed image of the
+    # engine into the bitmap painted on screen, in a hidden frame
+    import wx
+    import gui
+    frame = wx.Frame(None)
+    frame.SetClientSize(panel_size)
+    panel = gui.ImagePanel(frame, eng, gui.StartupTimings())
+    panel.SetSize(panel_size)
+    res = {}
+    res['panel_update_bitmap'] = measure(lambda i: panel.show_displayed(),
+                                         repeat)
+
+    def clear(i):
+        # drops the cached mipmaps and scaled bitmap, as after a load
+        panel.mipmaps = panel.mipmaps[:1]
+        panel.scaled = None
+    panel.zoom_fit()
+    res['panel_scale_fit'] = measure(lambda i: panel.get_scaled_bitmap(),
+                                     repeat, clear)
+    panel.zoom_1_1()
+    res['panel_scale_1_1'] = measure(lambda i: panel.get_scaled_bitmap(),
+                                     repeat, clear)
+
+    w, h = eng.size
+    rng = np.random.default_rng(2)
+    points = [(int(x), int(y)) for (x, y) in
+              zip(rng.integers(0, w, repeat + 1),
+                  rng.integers(0, h, repeat + 1))]
+    def change(i):
+        eng.reset(False)
+        eng.add_point(points[0], True)
+        panel.show_displayed()
+        panel.get_scaled_bitmap()
+        eng.add_point(points[i + 1], True)
+    panel.zoom_fit()
+    res['panel_patch'] = measure(lambda i: panel.show_displayed(), repeat,
+                                 change)
+    frame.Destroy()
+    return res
+
+
+def have_gui():
+    if sys.platform.startswith('linux') and not (
+            os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY')):
+        return False
+    try:
+        import wx
+    except ImportError:
+        return False
+    return True
+
+
+def print_results(results, reference=None, unit=' MP'):
+    for mp, ops in results.items():
+        print(f'\n{mp}{unit}')
+        print(f'  {"operation":<22} {"p50 ms":>10} {"p90 ms":>10} '
+              f'{"p99 ms":>10} {"peak MB":>9}' +
+              (f' {"vs ref":>8}' if reference else ''))
+        for op, r in ops.items():
+            line = f'  {op:<22} {r["p50_ms"]:10.2f} {r["p90_ms"]:10.2f} ' \
+                f'{r["p99_ms"]:10.2f} {r["peak_memory_mb"]:9.1f}'
+            if reference:
+                ref = reference.get(mp, {}).get(op)
+                if ref and ref['p50_ms'] > 0:
+                    line += f' {r["p50_ms"] / ref["p50_ms"]:7.2f}x'
+                else:
+                    line += f' {"-":>8}'
+            print(line)
+
+
+def getopts():
+    p = argparse.ArgumentParser(
+        description='benchmark the engine and GUI hot paths offline, '
+        'with a fake predictor and exiftool')
+    p.add_argument('-s', '--sizes', default='1,12,24,45,100',
+                   help='comma-separated image sizes in megapixels '
+                   '(default: %(default)s)')
+    p.add_argument('-n', '--repeat', type=int, default=10,
+                   help='repetitions per operation (default: %(default)s)')
+    p.add_argument('--format', default='tif', choices=['tif', 'png', 'jpg'],
+                   help='format of the synthetic images')
+    p.add_argument('--icc', action='store_true',
+                   help='use an sRGB display profile, to include the cost '
+                   'of the display colour transform')
+    p.add_argument('--no-gui', action='store_true',
+                   help='skip the wx bitmap benchmarks')
+    p.add_argument('--inference', nargs='?', const=','.join(
+        INFERENCE_VARIANTS), metavar='VARIANTS',
+                   help='instead of the engine and GUI benchmarks, time the '
+                   'encoder and decoder of the real model (as configured) '
+                   'with some inference options on an image of the first '
+                   'size, as a comma-separated list of: %(const)s '
+                   '(default: all)')
+    p.add_argument('-o', '--output',
+                   help='save the results to this JSON file')
+    p.add_argument('-c', '--compare',
+                   help='compare the results with a previous JSON file')
+    return p.parse_args()
+
+
+def main():
+    opts = getopts()
+    sizes = [float(s) for s in opts.sizes.split(',')]
+    if opts.inference:
+        variants = opts.inference.split(',')
+        for v in variants:
+            if v not in INFERENCE_VARIANTS:
+                sys.exit(f'unknown inference variant: {v}')
+        sizes = sizes[:1]
+    gui = not opts.no_gui and not opts.inference and have_gui()
+    if gui:
+        import wx
+        app = wx.App(False)
+    tmpdir = tempfile.mkdtemp(prefix='smart-bench-')
+    try:
+        conf = dataclasses.replace(
+            config.Config(), exiftool='', cache_dir=tmpdir,
+            embedding_cache_size=0, prefetch_depth=0)
+        if opts.icc:
+            profile = os.path.join(tmpdir, 'display.icc')
+            with open(profile, 'wb') as out:
+                out.write(ImageCms.ImageCmsProfile(
+                    ImageCms.createProfile('sRGB')).tobytes())
+            conf.display_icc_profile = profile
+        results = {}
+        for mp in sizes:
+            print(f'benchmarking {mp} MP...', file=sys.stderr)
+            fn = os.path.join(tmpdir, f'bench_{mp}.{opts.format}')
+            fn, size = make_image(fn, mp)
+            if opts.inference:
+                results = bench_inference(config.Config.load(), fn,
+                                          opts.repeat, variants)
+                break
+            eng, res = bench_engine(conf, fn, size, opts.repeat)
+            if gui:
+                res.update(bench_panel(eng, opts.repeat))
+            results[f'{mp:g}'] = res
+            del eng
+            os.remove(fn)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    reference = None
+    if opts.compare:
+        with open(opts.compare) as f:
+            reference = json.load(f)['results']
+    print_results(results, reference, '' if opts.inference else ' MP')
+    if opts.output:
+        data = {
+            'version': config.version,
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'cpu_count': os.cpu_count(),
+            'repeat': opts.repeat,
+            'icc': opts.icc,
+            'inference': opts.inference,
+            'results': results,
+        }
+        with open(opts.output, 'w') as out:
+            json.dump(data, out, indent=2)
+            out.write('\n')
+
+
+if __name__ == '__main__':
+    main()
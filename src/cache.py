@@ -0,0 +1,251 @@
+import os
+import mmap
+import time
+import sqlite3
+import hashlib
+import traceback
+from contextlib import closing
+
+from platformdirs import user_cache_dir
+
+
+def get_cache_dir(conf):
+    if conf.cache_dir:
+        return conf.cache_dir
+    return user_cache_dir("artpixls-SMART")
+
+
+def get_features(predictor):
+    feats = predictor._features
+    return {
+        'orig_hw': tuple(predictor._orig_hw[0]),
+        'image_embed': feats['image_embed'],
+        'high_res_feats': list(feats['high_res_feats']),
+    }
+
+
+def set_features(predictor, features):
+    predictor.reset_predictor()
+    predictor._orig_hw = [tuple(features['orig_hw'])]
+    predictor._features = {
+        'image_embed': features['image_embed'],
+        'high_res_feats': list(features['high_res_feats']),
+    }
+    predictor._is_image_set = True
+
+
+def features_size(features):
+    tensors = [features['image_embed']] + list(features['high_res_feats'])
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class EmbeddingCache:
+    suffix = '.pt'
+
+    def __init__(self, directory, max_size):
+        self.directory = os.path.join(directory, 'embeddings')
+        self.max_size = max_size * 1024 * 1024
+
+    @staticmethod
+    def from_config(conf):
+        return EmbeddingCache(get_cache_dir(conf), conf.embedding_cache_size)
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def key(self, sha256sum, model, device, size=None):
+        data = f'{sha256sum}:{model}:{device}'
+        if size is not None:
+            data += ':{}x{}'.format(*size)
+        data = data.encode('utf-8')
+        return hashlib.sha256(data).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def restore(self, predictor, key):
+        if not self.enabled:
+            return False
+        path = self._path(key)
+        if not os.path.exists(path):
+            return False
+        try:
+            import torch
+            data = torch.load(path, map_location=predictor.device,
+                              weights_only=True)
+            set_features(predictor, data)
+            os.utime(path)
+            return True
+        except Exception:
+            traceback.print_exc()
+            self._remove(path)
+            return False
+
+    def store(self, predictor, key):
+        if not self.enabled or not predictor._is_image_set:
+            return
+        import torch
+        feats = get_features(predictor)
+        data = {
+            'orig_hw': list(feats['orig_hw']),
+            'image_embed': feats['image_embed'].cpu(),
+            'high_res_feats': [f.cpu() for f in feats['high_res_feats']],
+        }
+        path = self._path(key)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            torch.save(data, tmp)
+            os.replace(tmp, path)
+            self.trim()
+        except Exception:
+            traceback.print_exc()
+            self._remove(tmp)
+
+    def entries(self):
+        res = []
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.endswith(self.suffix):
+                    path = os.path.join(self.directory, name)
+                    try:
+                        st = os.stat(path)
+                        res.append((path, st.st_size, st.st_mtime))
+                    except OSError:
+                        pass
+        res.sort(key=lambda e: e[2], reverse=True)
+        return res
+
+    def trim(self):
+        total = 0
+        for path, size, _ in self.entries():
+            total += size
+            if total > self.max_size:
+                self._remove(path)
+
+    def clear(self):
+        n = 0
+        for path, _, _ in self.entries():
+            if self._remove(path):
+                n += 1
+        return n
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    def info(self):
+        entries = self.entries()
+        mb = 1024 * 1024
+        lines = [
+            f'embedding cache: {self.directory}',
+            f'  entries: {len(entries)}',
+            f'  size: {sum(e[1] for e in entries) / mb:.1f} MB '
+            f'(limit: {self.max_size / mb:.0f} MB)',
+        ]
+        if entries:
+            fmt = '%Y-%m-%d %H:%M'
+            lines.append('  last used: ' +
+                         time.strftime(fmt, time.localtime(entries[0][2])))
+            lines.append('  least recently used: ' +
+                         time.strftime(fmt, time.localtime(entries[-1][2])))
+        return '\n'.join(lines)
+
+# end of class EmbeddingCache
+
+
+def file_sha256(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                h.update(m)
+        except (ValueError, OSError):
+            # empty files (or filesystems) that can't be mapped
+            f.seek(0)
+            h = hashlib.sha256()
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+class ChecksumIndex:
+    max_entries = 100000
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    @staticmethod
+    def from_config(conf):
+        if not conf.checksum_index:
+            return ChecksumIndex(None)
+        return ChecksumIndex(
+            os.path.join(get_cache_dir(conf), 'checksums.db'))
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        db = sqlite3.connect(self.filename, timeout=30)
+        db.execute('CREATE TABLE IF NOT EXISTS checksums ('
+                   'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, '
+                   'inode INTEGER, sha256 TEXT, used REAL)')
+        return db
+
+    @staticmethod
+    def _stamp(st):
+        return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def checksum(self, filename):
+        if self.filename is None:
+            return file_sha256(filename)
+        path = os.path.abspath(filename)
+        stamp = self._stamp(os.stat(path))
+        try:
+            with closing(self._connect()) as db, db:
+                row = db.execute('SELECT size, mtime_ns, inode, sha256 '
+                                 'FROM checksums WHERE path = ?',
+                                 (path,)).fetchone()
+                if row is not None and tuple(row[:3]) == stamp:
+                    db.execute('UPDATE checksums SET used = ? '
+                               'WHERE path = ?', (time.time(), path))
+                    return row[3]
+        except sqlite3.Error:
+            traceback.print_exc()
+            return file_sha256(path)
+        res = file_sha256(path)
+        if self._stamp(os.stat(path)) == stamp:
+            try:
+                with closing(self._connect()) as db, db:
+                    db.execute('INSERT OR REPLACE INTO checksums '
+                               'VALUES (?, ?, ?, ?, ?, ?)',
+                               (path, *stamp, res, time.time()))
+                    db.execute('DELETE FROM checksums WHERE path IN '
+                               '(SELECT path FROM checksums '
+                               'ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                               (self.max_entries,))
+            except sqlite3.Error:
+                traceback.print_exc()
+        return res
+
+    def __len__(self):
+        if self.filename is None or not os.path.exists(self.filename):
+            return 0
+        with closing(self._connect()) as db:
+            return db.execute('SELECT COUNT(*) FROM checksums').fetchone()[0]
+
+    def clear(self):
+        n = len(self)
+        if n:
+            with closing(self._connect()) as db, db:
+                db.execute('DELETE FROM checksums')
+        return n
+
+    def info(self):
+        if self.filename is None:
+            return 'checksum index: disabled'
+        return f'checksum index: {self.filename}\n  entries: {len(self)}'
+
+# end of class ChecksumIndex
@@ -15,9 +15,30 @@ class Config:
     mask_color: tuple[int, int, int] = (70, 230, 50)
     background_color: tuple[int, int, int] = (127, 127, 127)
     exiftool: str = "exiftool"
+    exiftool_timeout: int = 60
     window_size: int = 1200, 800
     last_dir: str = ""
     display_icc_profile: str|None = None
+    cache_dir: str|None = None
+    embedding_cache_size: int = 2048
+    checksum_index: bool = True
+    history_cache_size: int = 256
+    warmup: bool = False
+    prefetch_depth: int = 2
+    prefetch_memory: int = 1024
+    preview_size: int = 4096
+    draft_size: int = 2048
+    png_compress_level: int = 1
+    torch_threads: int = 0
+    torch_interop_threads: int = 0
+    inference_mode: bool = True
+    autocast_bf16: bool = False
+    quantize: bool = False
+    compile_model: bool = False
+    hover_preview: bool = False
+    hover_preview_budget: int = 200
+    trace_file: str|None = None
+    timing_readout: bool = False
 
     def get_model_config(self):
         if self.model_config is not None:
@@ -2,46 +2,586 @@ from pathlib import Path
 import io
 import os
 import json
-import subprocess
+import zlib
 import hashlib
+import base64
+import sys
+import threading
+import collections
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-from PIL import Image, ImageCms
-from sam2.build_sam import build_sam2
-from sam2.sam2_image_predictor import SAM2ImagePredictor
-import hydra
-from hydra.core.global_hydra import GlobalHydra
-if GlobalHydra.instance().is_initialized():
-    GlobalHydra.instance().clear()
+from PIL import Image, ImageCms, PngImagePlugin
+import cache
+import exiftool
+import inference
+import tracing
 
 
 def checksum(filename):
-    with open(filename, 'rb') as f:
-        return hashlib.sha256(f.read()).hexdigest()
+    return cache.file_sha256(filename)
+
+
+def read_mask_data(et, filenames):
+    tags = et.read_tags(filenames, ['Smart_mask_data'])
+    return [parse_mask_data(md.get('Smart_mask_data')) for md in tags]
+
+
+def parse_mask_data(data):
+    try:
+        info = json.loads(data)
+        if isinstance(info, dict):
+            fn = info.get('image')
+            cs = info.get('sha256sum')
+            ps = info.get('points')
+            ls = info.get('labels')
+            if isinstance(fn, str) and cs is not None \
+               and ps is not None and ls is not None and len(ps) == len(ls):
+                return info
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+LOGITS_KEY = 'Smart_mask_logits'
+
+
+def encode_logits(logits):
+    # compact text form of the low-resolution logits of a mask, stored in
+    # the PNG file so that reopening it does not need the model
+    a = np.asarray(logits, dtype=np.float16)
+    data = base64.b64encode(zlib.compress(a.tobytes())).decode('ascii')
+    return json.dumps({'shape': a.shape, 'data': data})
+
+
+def read_logits(filename):
+    try:
+        with Image.open(filename) as img:
+            data = img.info.get(LOGITS_KEY)
+        if data is None:
+            return None
+        info = json.loads(data)
+        a = np.frombuffer(zlib.decompress(base64.b64decode(info['data'])),
+                          dtype=np.float16)
+        return a.reshape(info['shape']).astype(np.float32)
+    except (OSError, ValueError, KeyError, TypeError, zlib.error):
+        return None
+
+
+def preview_size(size, max_size):
+    w, h = size
+    if max_size <= 0 or max(w, h) <= max_size:
+        return w, h
+    f = max_size / max(w, h)
+    return max(int(round(w * f)), 1), max(int(round(h * f)), 1)
+
+
+def decode_reduced(img, size):
+    # sets up img to be decoded at a reduced resolution, no smaller than
+    # size, when its format allows it: by DCT scaling for JPEG files, and
+    # from a reduced-resolution page for TIFF files. Returns whether it does
+    if img.format == 'JPEG':
+        full_size = img.size
+        img.draft('RGB', size)
+        return img.size != full_size
+    if img.format == 'TIFF' and getattr(img, 'n_frames', 1) > 1:
+        w, h = img.size
+        best = None
+        for i in range(1, img.n_frames):
+            img.seek(i)
+            pw, ph = img.size
+            # pages with another aspect ratio are not reductions of the
+            # image (e.g. thumbnails of another crop, or other images)
+            if pw >= size[0] and ph >= size[1] \
+               and abs(pw / ph - w / h) < 0.01 \
+               and (best is None or pw < best[1]):
+                best = (i, pw)
+        img.seek(best[0] if best is not None else 0)
+        return best is not None
+    return False
+
+
+def _bilinear(n_in, n_out):
+    # source indices and weights of a bilinear resize, with the same
+    # conventions as torch's interpolate(align_corners=False)
+    src = (np.arange(n_out, dtype=np.float32) + 0.5) * (n_in / n_out) - 0.5
+    np.maximum(src, 0, out=src)
+    i0 = np.minimum(src.astype(np.int64), n_in - 1)
+    i1 = np.minimum(i0 + 1, n_in - 1)
+    return i0, i1, src - i0
+
+
+def upsample_mask(logits, size, strip_pixels=1 << 22):
+    # thresholds the bilinear upsampling of the low-resolution logits to
+    # the full image size, like SAM2 does to compute its masks, one strip
+    # at a time so that the float buffers stay small
+    w, h = size
+    logits = np.asarray(logits, dtype=np.float32).reshape(logits.shape[-2:])
+    lh, lw = logits.shape
+    y0, y1, wy = _bilinear(lh, h)
+    x0, x1, wx = _bilinear(lw, w)
+    res = np.empty((h, w), dtype=np.uint8)
+    step = max(1, strip_pixels // w)
+    for y in range(0, h, step):
+        s = slice(y, y + step)
+        fy = wy[s, None]
+        rows = logits[y0[s]] * (1 - fy) + logits[y1[s]] * fy
+        vals = rows[:, x0] * (1 - wx) + rows[:, x1] * wx
+        res[s] = np.where(vals > 0, np.uint8(255), np.uint8(0))
+    return res
+
+
+def set_image_size(predictor, size):
+    # SAM2ImagePredictor normalizes the point coordinates by, and upsamples
+    # the masks to, the size of the image it was given, which it keeps in
+    # its private _orig_hw: this sets that size to (w, h) (e.g. after the
+    # image was decoded again at another resolution), and returns the
+    # previous one. Only this function changes it, and the callers hold
+    # the engine lock
+    h, w = predictor._orig_hw[0]
+    predictor._orig_hw = [(size[1], size[0])]
+    return w, h
+
+
+def layer_filename(filename, name):
+    # file name of the mask of an additional layer, given the one of the
+    # first layer: image_mask.png -> image_<name>_mask.png
+    root, ext = os.path.splitext(filename)
+    if root.endswith('_mask'):
+        return f'{root[:-5]}_{name}_mask{ext}'
+    return f'{root}_{name}{ext}'
+
+
+def changed_rect(a, b):
+    # bounding box (x0, y0, x1, y1) of the pixels that differ between the
+    # masks a and b, empty if they are the same
+    diff = a != b
+    rows = np.flatnonzero(diff.any(axis=1))
+    if not len(rows):
+        return 0, 0, 0, 0
+    y0, y1 = int(rows[0]), int(rows[-1]) + 1
+    cols = np.flatnonzero(diff[y0:y1].any(axis=0))
+    return int(cols[0]), y0, int(cols[-1]) + 1, y1
+
+
+def reset_peak_rss():
+    # resets the peak resident set size of the process (Linux only), so
+    # that peak_rss() gives the peak from now on; returns whether it did
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss():
+    # the peak resident set size since the last reset_peak_rss()
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def max_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class PredictionCache:
+    def __init__(self, max_size):
+        self.max_size = max_size * 1024 * 1024
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    @staticmethod
+    def key(points, labels):
+        return tuple(tuple(p) for p in points), tuple(labels)
+
+    def get(self, points, labels):
+        key = self.key(points, labels)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        packed, shape, logits = entry
+        mask = np.unpackbits(packed, count=shape[0] * shape[1])
+        return mask.view(bool).reshape(shape), logits
+
+    def put(self, points, labels, mask, logits):
+        if self.max_size <= 0:
+            return
+        key = self.key(points, labels)
+        self._remove(key)
+        entry = (np.packbits(mask), mask.shape, logits)
+        self.entries[key] = entry
+        self.size += entry[0].nbytes + logits.nbytes
+        while self.size > self.max_size and len(self.entries) > 1:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[0].nbytes + entry[2].nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+# end of class PredictionCache
+
+
+class LoadedImage:
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self.stamp = self._stamp()
+        self.size = None
+        self.image = None
+        self.plain_image = None
+        self.overlay = None
+        self.features = None
+        # whether image is a quick draft, smaller than the preview size
+        self.reduced = False
+
+    def _stamp(self):
+        st = os.stat(self.filename)
+        return st.st_size, st.st_mtime_ns
+
+    def is_valid(self):
+        try:
+            return self._stamp() == self.stamp
+        except OSError:
+            return False
+
+    def nbytes(self):
+        res = self.image.nbytes
+        if self.plain_image is not self.image:
+            res += self.plain_image.nbytes
+        if self.overlay is not None:
+            res += sum(a.nbytes for a in self.overlay)
+        if self.features is not None:
+            res += cache.features_size(self.features)
+        return res
+
+# end of class LoadedImage
+
+
+class ImageCache:
+    def __init__(self, max_size):
+        self.max_size = max_size * 1024 * 1024
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, filename, remove=False):
+        filename = os.path.abspath(filename)
+        with self.lock:
+            entry = self.entries.get(filename)
+            if entry is not None and not entry.is_valid():
+                del self.entries[filename]
+                entry = None
+            if entry is not None:
+                if remove:
+                    del self.entries[filename]
+                else:
+                    self.entries.move_to_end(filename)
+            return entry
+
+    def put(self, entry):
+        with self.lock:
+            self.entries.pop(entry.filename, None)
+            if entry.nbytes() > self.max_size:
+                return
+            self.entries[entry.filename] = entry
+            size = sum(e.nbytes() for e in self.entries.values())
+            while size > self.max_size:
+                _, e = self.entries.popitem(last=False)
+                size -= e.nbytes()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+# end of class ImageCache
+
+
+class Prefetcher:
+    def __init__(self, engine):
+        self.engine = engine
+        self.cond = threading.Condition()
+        self.queue = []
+        self.generation = 0
+        self.active = None
+        self.thread = None
+
+    def schedule(self, filenames):
+        with self.cond:
+            self.queue = list(filenames)
+            self.generation += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+
+    def wait_for(self, filename):
+        filename = os.path.abspath(filename)
+        with self.cond:
+            while self.active == filename:
+                self.cond.wait()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                filename = self.queue.pop(0)
+                gen = self.generation
+                self.active = os.path.abspath(filename)
+            try:
+                self.engine.prefetch(filename,
+                                     lambda: self.generation != gen)
+            except LoadCancelled:
+                pass
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self.cond:
+                    self.active = None
+                    self.cond.notify_all()
+
+# end of class Prefetcher
+
+
+class MaskLayer:
+    def __init__(self, name, points=(), labels=()):
+        self.name = name
+        self.points = list(points)
+        self.labels = list(labels)
+        self.redo_points = []
+        self.mask = None
+        self.mask_input = None
+        # whether the prompts changed since the mask was computed, when its
+        # computation is left to the prediction worker
+        self.stale = False
+
+    def copy(self):
+        # masks are never modified in place, so they can be shared
+        res = MaskLayer(self.name, self.points, self.labels)
+        res.mask = self.mask
+        res.mask_input = self.mask_input
+        res.stale = self.stale
+        return res
+
+# end of class MaskLayer
+
+
+def mask_prompt(layer):
+    # the logits given to the predictor with the next points of layer: a
+    # mask without points (propagated from another frame) is not a mask
+    # prompt for the image predictor
+    return layer.mask_input if layer.points else None
+
+
+def full_mask(layer, size, scale):
+    if layer.mask is None:
+        return np.zeros((size[1], size[0]), dtype=np.uint8)
+    elif scale != (1.0, 1.0):
+        with tracing.span('upsample'):
+            return upsample_mask(layer.mask_input, size)
+    else:
+        return np.where(layer.mask, np.uint8(255), np.uint8(0))
+
+
+class SaveJob:
+    # a snapshot of the masks to save, so that editing can go on while
+    # they are written. image is the (filename, size, scale) of the image
+    # the masks belong to, by default the current one of the engine, and
+    # data extra fields for their Smart_mask_data
+    def __init__(self, engine, items, names=None, image=None, data=None):
+        if image is None:
+            image = (engine.image_filename, engine.size, engine.scale)
+        self.image_filename, self.size, self.scale = image
+        self.model = engine.conf.model
+        self.items = [(layer.copy(), fn) for (layer, fn) in items]
+        if names is None:
+            names = [os.path.basename(fn) for (_, fn) in items]
+        self.names = names
+        self.data = data or {}
+        self.error = None
+
+# end of class SaveJob
+
+
+class MaskSaver:
+    # writes the queued SaveJobs one at a time, in order
+    def __init__(self, engine):
+        self.engine = engine
+        self.cond = threading.Condition()
+        self.queue = collections.deque()
+        self.busy = False
+        self.errors = []
+        self.thread = None
+
+    def submit(self, job, progress=None, done=None):
+        with self.cond:
+            self.queue.append((job, progress, done))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+
+    def pending(self):
+        with self.cond:
+            return len(self.queue) + int(self.busy)
+
+    def wait(self):
+        # waits until all the jobs are written, and returns (and forgets)
+        # the ones that failed
+        with self.cond:
+            self.cond.wait_for(lambda: not self.queue and not self.busy)
+            res, self.errors = self.errors, []
+            return res
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                job, progress, done = self.queue.popleft()
+                self.busy = True
+            try:
+                self.engine.write_masks(job, progress)
+            except Exception as e:
+                traceback.print_exc()
+                job.error = e
+                if job.image_filename == self.engine.image_filename:
+                    self.engine.saved = False
+            try:
+                if done is not None:
+                    done(job)
+            finally:
+                with self.cond:
+                    if job.error is not None:
+                        self.errors.append(job)
+                    self.busy = False
+                    self.cond.notify_all()
+
+# end of class MaskSaver
+
+
+class PredictionWorker:
+    # runs func() and then done(result, error) off the caller's thread,
+    # latest request wins: requests superseded before their computation
+    # starts are skipped, and the results of those superseded while being
+    # computed are discarded
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.pending = None
+        self.thread = None
+
+    def submit(self, func, done):
+        with self.cond:
+            self.pending = (func, done)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.pending is None:
+                    self.cond.wait()
+                func, done = self.pending
+                self.pending = None
+            try:
+                res = func()
+                err = None
+            except Exception as e:
+                traceback.print_exc()
+                res, err = None, e
+            with self.cond:
+                if self.pending is not None:
+                    continue
+            done(res, err)
+
+# end of class PredictionWorker
+
+
+def _layer_attribute(name):
+    return property(lambda self: getattr(self.layer, name),
+                    lambda self, value: setattr(self.layer, name, value))
+
+
+def _no_progress(stage, msg=None):
+    pass
+
+
+class LoadCancelled(Exception):
+    pass
 
 
 class AIMaskingEngine:
-    def __init__(self, conf):
+    default_layer = 'mask'
+    # changes of the mask covering more than this fraction of the image
+    # redraw all of it
+    max_damage = 0.25
+
+    # prompts and masks of the current layer
+    points = _layer_attribute('points')
+    labels = _layer_attribute('labels')
+    redo_points = _layer_attribute('redo_points')
+    mask = _layer_attribute('mask')
+    mask_input = _layer_attribute('mask_input')
+    stale = _layer_attribute('stale')
+
+    def __init__(self, conf, load_model=True):
         self.conf = conf
-        sam2_checkpoint = self.conf.get_model_file()
-        model_cfg_dir, model_cfg = self.conf.get_model_config()
-        with hydra.initialize(version_base=None,
-                              config_path=model_cfg_dir):
-            self.sam2_model = build_sam2(model_cfg,
-                                         sam2_checkpoint,
-                                         device=self.conf.device)
-            self.sam2_model.eval()
-        self.predictor = SAM2ImagePredictor(self.sam2_model)
+        self.sam2_model = None
+        self.predictor = None
+        self.prefetch_predictor = None
+        self.model_ready = threading.Event()
+        self.model_error = None
+        self.model_lock = threading.Lock()
+        self.inference = inference.InferenceOptions()
+        self.embedding_cache = cache.EmbeddingCache.from_config(self.conf)
+        self.checksums = cache.ChecksumIndex.from_config(self.conf)
+        self.lock = threading.RLock()
+        self.exiftool = exiftool.ExifTool.from_config(self.conf)
         self.image_filename = None
         self.image = None
-        self.mask = None
-        self.mask_input = None
+        self.layers = [MaskLayer(self.default_layer)]
+        self.layer = self.layers[0]
+        self.overlay = None
+        self.overlay_future = None
+        self.overlay_pool = ThreadPoolExecutor(max_workers=1)
+        self.plain_image = None
         self.displayed_image = None
+        self.displayed_mask = None
+        self.damage = None
+        self.display_version = 0
+        self.peak_memory = None
         self.saved = True
         self.size = -1, -1
-        self.points = []
-        self.labels = []
+        self.scale = 1.0, 1.0
+        self.reduced = False
+        self.results = PredictionCache(self.conf.history_cache_size)
+        self.prefetched = ImageCache(self.conf.prefetch_memory)
+        self.prefetcher = Prefetcher(self)
+        self.saver = MaskSaver(self)
+        self.predictions = PredictionWorker()
+        self.previews = PredictionWorker()
         self.srgb_profile = ImageCms.createProfile('sRGB')
+        self.transforms = {}
+        self.transforms_lock = threading.Lock()
         if self.conf.display_icc_profile:
             display_profile = ImageCms.ImageCmsProfile(
                 self.conf.display_icc_profile)
@@ -52,137 +592,796 @@ class AIMaskingEngine:
                 self.srgb_profile, display_profile, "RGB", "RGB")
         else:
             self.display_xform = None
+        if load_model:
+            self.load_model()
+
+    def load_model(self):
+        # sam2, hydra and torch are imported here rather than at module
+        # level, as they are slow to import
+        with self.model_lock:
+            if self.model_ready.is_set():
+                return
+            try:
+                from sam2.build_sam import build_sam2
+                from sam2.sam2_image_predictor import SAM2ImagePredictor
+                import hydra
+                from hydra.core.global_hydra import GlobalHydra
+                if GlobalHydra.instance().is_initialized():
+                    GlobalHydra.instance().clear()
+                inference.set_threads(self.conf)
+                sam2_checkpoint = self.conf.get_model_file()
+                model_cfg_dir, model_cfg = self.conf.get_model_config()
+                with hydra.initialize(version_base=None,
+                                      config_path=model_cfg_dir):
+                    self.sam2_model = build_sam2(model_cfg,
+                                                 sam2_checkpoint,
+                                                 device=self.conf.device)
+                    self.sam2_model.eval()
+                self.predictor = SAM2ImagePredictor(self.sam2_model)
+                self.prefetch_predictor = SAM2ImagePredictor(self.sam2_model)
+                self.inference = inference.setup(self.sam2_model,
+                                                 self.predictor, self.conf)
+                if self.conf.warmup:
+                    self.warmup()
+            except Exception as e:
+                self.model_error = e
+                raise
+            finally:
+                self.model_ready.set()
+
+    def warmup(self):
+        # run the encoder and decoder once on a dummy image, so that the
+        # backend selects its kernels before the first real image
+        img = np.zeros((64, 64, 3), dtype=np.uint8)
+        with self.inference.context():
+            self.predictor.set_image(img)
+            self.predictor.predict(point_coords=[[32, 32]],
+                                   point_labels=[1], multimask_output=False)
+        self.predictor.reset_predictor()
+
+    def wait_model(self):
+        self.model_ready.wait()
+        if self.model_error is not None:
+            raise self.model_error
+
+    def load_image(self, filename, progress=None, cancelled=None):
+        def step(stage, msg=None):
+            if cancelled is not None and cancelled():
+                raise LoadCancelled()
+            if progress is not None:
+                progress(stage, msg)
+        with self.lock, tracing.span('load'):
+            # the peak memory of the process (other threads included)
+            # while loading the image, where it can be measured
+            tracked = reset_peak_rss()
+            self.peak_memory = None
+            self.stash_image()
+            self.reset(True)
+            step('metadata', 'reading metadata...')
+            logits = None
+            with tracing.span('metadata'):
+                info = self.read_mask_data(filename)
+                fn = filename
+                if info is not None and os.path.exists(info['image']) \
+                   and self.checksum(info['image']) == info['sha256sum']:
+                    fn = info['image']
+                    saved = self.read_layers(filename, info)
+                    layers = [(md.get('layer', self.default_layer),
+                               md['points'], md['labels'])
+                              for (_, md) in saved]
+                    # the saved masks are shown as they are, and the
+                    # encoder runs only when they are edited
+                    if info.get('model') == self.conf.model:
+                        logits = [read_logits(f) for (f, _) in saved]
+                        if any(l is None and md['points']
+                               for l, (_, md) in zip(logits, saved)):
+                            logits = None
+                else:
+                    info = None
+            self.open_image(fn, step, encode=logits is None, quick=True)
+            if logits is not None:
+                self.restore_layers(layers, logits)
+            elif info is not None:
+                step('predict', 'computing mask...')
+                self.set_layers(layers)
+            if tracked:
+                self.peak_memory = peak_rss()
+
+    def image_memory(self):
+        # bytes held by the pixel buffers of the current image
+        if self.image is None:
+            return 0
+        res = self.image.nbytes
+        for a in [self.plain_image] + list(self.overlay or ()):
+            if a is not None and a is not self.image:
+                res += a.nbytes
+        return res
 
-    def load_image(self, filename):
-        self.reset(True)
-        def doit(fn):
-            img = Image.open(fn).convert('RGB')
-            icc = img.info.get('icc_profile')
-            if icc is not None:
-                try:
+    def memory_report(self):
+        res = [f'image buffers: {self.image_memory() >> 20} MB']
+        if self.peak_memory is not None:
+            res.append(f'peak memory while loading: '
+                       f'{self.peak_memory >> 20} MB')
+        else:
+            rss = max_rss()
+            if rss is not None:
+                res.append(f'max process memory: {rss >> 20} MB')
+        return ', '.join(res)
+
+    def open_image(self, filename, step=None, encode=True, quick=False):
+        if step is None:
+            step = _no_progress
+        self.prefetcher.wait_for(filename)
+        state = self.prefetched.get(filename, remove=True)
+        if state is None:
+            step('decode', 'decoding image...')
+            with tracing.span('decode'):
+                state = self.decode_image(filename, quick)
+        self.size = state.size
+        self.reduced = state.reduced
+        self.image = state.image
+        self.scale = (state.image.shape[1] / self.size[0],
+                      state.image.shape[0] / self.size[1])
+        self.mask = None
+        self.overlay = state.overlay
+        self.results.clear()
+        self.plain_image = state.plain_image
+        self.set_display(self.plain_image, None)
+        self.start_overlay()
+        step('decoded')
+        if state.features is not None:
+            cache.set_features(self.predictor, state.features)
+        elif encode:
+            self.encode_image(filename, step)
+        self.image_filename = state.filename
+
+    def refine_image(self):
+        # replaces the quick draft the current image was opened with by
+        # its decoding at the preview size, keeping the embeddings and the
+        # masks (which are computed again from their logits); returns
+        # whether it did
+        filename = self.image_filename
+        if not self.reduced or filename is None:
+            return False
+        with tracing.span('refine'):
+            _, image = self.read_image(filename)
+            plain_image = self.to_display(image)
+            overlay = self.make_overlay(image)
+        with self.lock:
+            if self.image_filename != filename or not self.reduced:
+                return False
+            h, w = image.shape[:2]
+            self.image = image
+            self.plain_image = plain_image
+            if self.overlay_future is not None:
+                self.overlay_future.cancel()
+                self.overlay_future = None
+            self.overlay = overlay
+            self.scale = (w / self.size[0], h / self.size[1])
+            self.reduced = False
+            if self.predictor is not None and self.predictor._is_image_set:
+                set_image_size(self.predictor, (w, h))
+            self.results.clear()
+            for layer in self.layers:
+                if layer.mask_input is not None:
+                    layer.mask = upsample_mask(layer.mask_input, (w, h)) > 0
+            self.set_display(self.plain_image, None)
+            self.update_display()
+        return True
+
+    def ensure_encoded(self):
+        # images opened without running the encoder are encoded when the
+        # model is first needed
+        if self.predictor is None or not self.predictor._is_image_set:
+            self.encode_image(self.image_filename)
+
+    def decode_image(self, filename, quick=False):
+        # with quick, images that can be decoded at a reduced resolution
+        # are decoded at draft_size only, and refine_image() decodes them
+        # at the preview size later
+        res = LoadedImage(filename)
+        max_size = None
+        if quick and self.conf.draft_size > 0:
+            with Image.open(filename) as img:
+                size = preview_size(img.size, self.conf.preview_size)
+                draft = preview_size(img.size, self.conf.draft_size)
+                if draft[0] < size[0] and decode_reduced(img, draft):
+                    max_size = self.conf.draft_size
+                    res.reduced = True
+        res.size, res.image = self.read_image(filename, max_size)
+        res.plain_image = self.to_display(res.image)
+        return res
+
+    def read_image(self, filename, max_size=None):
+        # returns the size of the image and its sRGB pixels, reduced to
+        # max_size (by default the preview size)
+        if max_size is None:
+            max_size = self.conf.preview_size
+        img = Image.open(filename)
+        icc = img.info.get('icc_profile')
+        full_size = img.size
+        # very large images are worked on at a reduced resolution: SAM2
+        # sees them at 1024 pixels anyway, and the full-resolution mask is
+        # only computed by save_mask. Where possible, the image is not even
+        # decoded at full resolution
+        size = preview_size(full_size, max_size)
+        if size != full_size:
+            with tracing.span('draft'):
+                decode_reduced(img, size)
+        img = img.convert('RGB')
+        if size != img.size:
+            img = img.resize(size, Image.LANCZOS, reducing_gap=3.0)
+        if icc is not None:
+            try:
+                ImageCms.applyTransform(img, self.srgb_transform(icc), True)
+            except:
+                traceback.print_exc()
+        res = np.array(img)
+        img.close()
+        del img
+        return full_size, res
+
+    def srgb_transform(self, icc):
+        # the transforms from the embedded profiles of the images to sRGB,
+        # by checksum of the profile, as most images share a few of them
+        key = hashlib.sha256(icc).digest()
+        with self.transforms_lock:
+            xform = self.transforms.get(key)
+            if xform is None:
+                with tracing.span('build transform'):
                     iprof = ImageCms.ImageCmsProfile(io.BytesIO(icc))
                     xform = ImageCms.buildTransform(
                         iprof, self.srgb_profile, "RGB", "RGB")
-                    ImageCms.applyTransform(img, xform, True)
-                except:
-                    import traceback
-                    traceback.print_exc()
-            self.size = img.size
-            self.image = np.array(img).astype(np.float32) / 255.0
-            self.mask = None
-            self.displayed_image = self.to_display(self.image)
-            self.predictor.set_image(self.image)
-            self.image_filename = os.path.abspath(fn)
-        if self.conf.exiftool:
+                self.transforms[key] = xform
+        return xform
+
+    def stash_image(self):
+        # keep the current image and its embedding around, so that going
+        # back to it is instant
+        if self.conf.prefetch_depth > 0 and self.image is not None \
+           and self.predictor is not None and self.predictor._is_image_set:
             try:
-                res = subprocess.run(
-                    [self.conf.exiftool, '-json', '-Smart_mask_data', filename],
-                    encoding='utf-8', capture_output=True, check=True)
-                md = json.loads(res.stdout)[0]
-                info = json.loads(md['Smart_mask_data'])
-                if info is not None and isinstance(info, dict):
-                    fn = info.get('image', '')
-                    cs = info.get('sha256sum')
-                    ps = info.get('points')
-                    ls = info.get('labels')
-                    if os.path.exists(fn) and cs is not None \
-                       and ps is not None and ls is not None \
-                       and len(ps) == len(ls) and checksum(fn) == cs:
-                        doit(fn)
-                        self.points = ps
-                        self.labels = ls
-                        self.predict()
-                        return
-            except Exception:
+                state = LoadedImage(self.image_filename)
+            except OSError:
+                return
+            state.size = self.size
+            state.reduced = self.reduced
+            state.image = self.image
+            state.plain_image = self.plain_image
+            state.overlay = self.get_overlay()
+            state.features = cache.get_features(self.predictor)
+            self.prefetched.put(state)
+
+    def prefetch_images(self, filenames):
+        if self.conf.prefetch_depth > 0:
+            self.prefetcher.schedule(filenames[:self.conf.prefetch_depth])
+
+    def prefetch(self, filename, cancelled=None):
+        def check():
+            if cancelled is not None and cancelled():
+                raise LoadCancelled()
+        if self.prefetched.get(filename) is not None \
+           or os.path.abspath(filename) == self.image_filename:
+            return
+        self.wait_model()
+        check()
+        with tracing.span('prefetch'):
+            with tracing.span('decode'):
+                state = self.decode_image(filename)
+            with tracing.span('overlay'):
+                state.overlay = self.make_overlay(state.image)
+            check()
+            with tracing.span('encode'):
+                state.features = self.encode(self.prefetch_predictor,
+                                             state.image, filename,
+                                             state.size)
+            self.prefetch_predictor.reset_predictor()
+        self.prefetched.put(state)
+
+    def read_layers(self, filename, info):
+        # the masks saved together with the given one, as (mask file, mask
+        # data) pairs
+        d = os.path.dirname(filename)
+        names = info.get('layers')
+        if not isinstance(names, list) \
+           or os.path.basename(filename) not in names \
+           or self.exiftool is None:
+            return [(filename, info)]
+        others = [os.path.join(d, n) for n in names
+                  if n != os.path.basename(filename)
+                  and os.path.exists(os.path.join(d, n))]
+        try:
+            found = dict(zip(others, read_mask_data(self.exiftool, others)))
+        except exiftool.ExifToolError:
+            found = {}
+        found[filename] = info
+        res = []
+        for n in names:
+            fn = os.path.join(d, n)
+            md = found.get(fn)
+            if md is not None and md['image'] == info['image'] \
+               and md['sha256sum'] == info['sha256sum']:
+                res.append((fn, md))
+        return res
+
+    def read_mask_data(self, filename):
+        if self.exiftool is not None:
+            try:
+                return read_mask_data(self.exiftool, [filename])[0]
+            except exiftool.ExifToolError:
                 pass
-        doit(filename)
+        return None
+
+    def encode_image(self, filename, step=None):
+        if step is None:
+            step = _no_progress
+        if not self.model_ready.is_set():
+            step('model', 'waiting for the model to be loaded...')
+        self.wait_model()
+        step('encode', 'computing image embeddings...')
+        with tracing.span('encode'):
+            self.encode(self.predictor, self.image, filename, self.size)
+
+    def encode(self, predictor, image, filename, size=None):
+        key = None
+        if self.embedding_cache.enabled:
+            # embeddings of reduced images are kept apart from those of
+            # the full-resolution ones
+            h, w = image.shape[:2]
+            reduced = (w, h) if size is not None and (w, h) != size else None
+            with tracing.span('checksum'):
+                key = self.embedding_cache.key(self.checksum(filename),
+                                               self.model_id(),
+                                               self.conf.device, reduced)
+            with tracing.span('embedding cache'):
+                found = self.embedding_cache.restore(predictor, key)
+            if found:
+                return cache.get_features(predictor)
+        with tracing.span('encoder'):
+            with self.inference.context():
+                predictor.set_image(image)
+        if key is not None:
+            with tracing.span('embedding store'):
+                self.embedding_cache.store(predictor, key)
+        return cache.get_features(predictor)
+
+    def model_id(self):
+        return self.conf.model + self.inference.key()
+
+    def checksum(self, filename):
+        return self.checksums.checksum(filename)
 
     def get_size(self):
         return self.size
 
-    def add_point(self, point, is_positive):
+    def add_point(self, point, is_positive, predict=True):
         self.saved = False
+        self.mask_input = mask_prompt(self.layer)
         self.points.append(point)
         self.labels.append(int(is_positive))
-        self.predict()
+        self.redo_points = []
+        self.changed(predict)
+
+    def changed(self, predict):
+        # the prompts of the current layer changed: its mask is computed
+        # now, or marked as stale until predict_async() delivers it
+        if predict:
+            self.predict()
+        else:
+            self.layer.stale = True
+
+    def set_layers(self, layers):
+        # layers is a list of (name, points, labels); the masks of all the
+        # layers are computed in one decoder pass
+        self.layers = [MaskLayer(*l) for l in layers] or \
+            [MaskLayer(self.default_layer)]
+        self.layer = self.layers[0]
+        with tracing.span('predict'):
+            self.predict_layers(self.layers)
+            self.update_display()
+
+    def restore_layers(self, layers, logits):
+        # sets the layers with the saved logits of their masks, without
+        # running the model; masks without points were propagated from
+        # another frame, and are shown but not cached as predictions
+        self.layers = [MaskLayer(*l) for l in layers]
+        self.layer = self.layers[0]
+        h, w = self.image.shape[:2]
+        with tracing.span('restore'):
+            for layer, mask_input in zip(self.layers, logits):
+                if mask_input is not None:
+                    layer.mask_input = mask_input
+                    layer.mask = upsample_mask(mask_input, (w, h)) > 0
+                    if layer.points:
+                        self.results.put(layer.points, layer.labels,
+                                         layer.mask, layer.mask_input)
+            self.update_display()
+
+    def add_layer(self, name=None):
+        names = set(l.name for l in self.layers)
+        if name is None:
+            i = len(self.layers) + 1
+            while f'layer{i}' in names:
+                i += 1
+            name = f'layer{i}'
+        elif name in names:
+            raise ValueError(f'a layer called "{name}" already exists')
+        self.layer = MaskLayer(name)
+        self.layers.append(self.layer)
+        self.update_display()
+        return self.layer
+
+    def select_layer(self, index):
+        self.layer = self.layers[index]
+        self.update_display()
+
+    def remove_layer(self, index):
+        if len(self.layers) > 1:
+            layer = self.layers.pop(index)
+            if layer.points:
+                self.saved = False
+            if layer is self.layer:
+                self.layer = self.layers[min(index, len(self.layers) - 1)]
+            self.update_display()
 
     def predict(self):
-        if self.image is not None:
+        with self.lock, tracing.span('predict'):
+            self.predict_layers([self.layer])
+            self.update_display()
+
+    def predict_async(self, done):
+        # done(apply, error) is called from the worker thread when the
+        # mask of the current layer is ready (unless it was superseded in
+        # the meantime); apply() stores the mask in the layer unless its
+        # prompts changed since the request, and returns whether the
+        # displayed image was updated
+        layer = self.layer
+        snapshot = layer.copy()
+
+        def finished(displayed, err):
+            if err is not None:
+                done(None, err)
+            else:
+                done(lambda: self.apply_prediction(layer, snapshot,
+                                                   displayed), None)
+        self.predictions.submit(lambda: self.compute(snapshot), finished)
+
+    def preview(self, point):
+        # the mask that adding a positive point would give, at the 256x256
+        # resolution of the logits (stretched over the whole image); the
+        # predictor is told the image has that size while predicting, so
+        # that it does not upsample the mask to the full image
+        with self.lock, tracing.span('preview'):
+            if self.image is None or self.predictor is None \
+               or not self.predictor._is_image_set:
+                return None
+            layer = self.layer
+            res = 256
+            f = (res / self.size[0], res / self.size[1])
+            coords = np.array(layer.points + [point], dtype=np.float32) * f
+            labels = np.array(layer.labels + [1], dtype=np.int32)
+            size = set_image_size(self.predictor, (res, res))
+            try:
+                with tracing.span('decoder'), self.inference.context():
+                    _, _, logits = self.predictor.predict(
+                        point_coords=coords,
+                        point_labels=labels,
+                        mask_input=mask_prompt(layer),
+                        multimask_output=False
+                    )
+            finally:
+                set_image_size(self.predictor, size)
+            return logits.reshape(logits.shape[-2:]) > 0
+
+    def preview_async(self, point, done):
+        # done(mask, error) is called from the worker thread
+        self.previews.submit(lambda: self.preview(point), done)
+
+    def compute(self, layer):
+        # computes the mask of layer and the update of the displayed image,
+        # without changing the current state
+        with self.lock, tracing.span('predict'):
+            self.predict_layers([layer])
+            return self.render(layer.mask)
+
+    def apply_prediction(self, layer, snapshot, update):
+        with self.lock:
+            if layer not in self.layers or layer.points != snapshot.points \
+               or layer.labels != snapshot.labels or self.image is None:
+                return False
+            layer.mask = snapshot.mask
+            layer.mask_input = snapshot.mask_input
+            layer.stale = False
+            h, w = self.image.shape[:2]
+            if layer.mask is not None and layer.mask.shape != (h, w):
+                # the image was refined in the meantime
+                layer.mask = upsample_mask(layer.mask_input, (w, h)) > 0
+                update = self.render(layer.mask)
+            if layer is not self.layer:
+                return False
+            self.show(layer.mask, update)
+            return True
+
+    def flush_predictions(self):
+        # computes the masks still left to the prediction worker (waiting
+        # for the one it is computing, whose result is then cached), so
+        # that they match their prompts; returns whether there were any
+        with self.lock:
+            layers = [l for l in self.layers if l.stale]
+            if layers and self.image is not None:
+                with tracing.span('predict'):
+                    self.predict_layers(layers)
+                    self.update_display()
+            return bool(layers)
+
+    def predict_layers(self, layers):
+        if self.image is None:
+            return
+        todo = []
+        for layer in layers:
+            res = None
+            if layer.points:
+                res = self.results.get(layer.points, layer.labels)
+                if res is None:
+                    todo.append(layer)
+                    continue
+            layer.mask, layer.mask_input = res or (None, None)
+            layer.stale = False
+        # mask_input must be given for all the prompts of a batch or for
+        # none of them
+        for batch in ([l for l in todo if l.mask_input is None],
+                      [l for l in todo if l.mask_input is not None]):
+            if batch:
+                self.decode(batch)
+
+    def decode(self, layers):
+        # all the prompts are padded to the same length with "not a point"
+        # entries (label -1), so that SAM2 decodes them in a single batch
+        self.ensure_encoded()
+        n = max(len(l.points) for l in layers)
+        coords = np.zeros((len(layers), n, 2), dtype=np.float32)
+        labels = np.full((len(layers), n), -1, dtype=np.int32)
+        for i, l in enumerate(layers):
+            coords[i, :len(l.points)] = l.points
+            labels[i, :len(l.labels)] = l.labels
+        coords *= self.scale
+        mask_input = None
+        if layers[0].mask_input is not None:
+            mask_input = np.stack([l.mask_input for l in layers])
+        with tracing.span('decoder'), self.inference.context():
             masks, scores, logits = self.predictor.predict(
-                point_coords=self.points,
-                point_labels=self.labels,
-                mask_input=self.mask_input,
+                point_coords=coords,
+                point_labels=labels,
+                mask_input=mask_input,
                 multimask_output=False
             )
-            self.mask = masks[0]
-            self.mask_input = logits[0, :, :][None, :, :]
-            c = np.array(self.conf.mask_color, dtype=np.float32) / 255.0
-            cm = np.zeros_like(self.image)[:,:] = c
-            zm = np.zeros_like(self.image)
-            m = np.repeat(np.expand_dims(self.mask, axis=2), 3, axis=2)
-            m = np.where(m > 0, cm, zm)
-            s = 0.5
-            w = [0.2225045 * (1-s),  0.7168786 * (1-s),  0.0606169 * (1-s)]
-            desat = np.array([
-                [w[0] + s, w[0], w[0]],
-                [w[1], w[1] + s, w[1]],
-                [w[2], w[2], w[2] + s]
-            ], dtype=np.float32).transpose()
-            img = (desat @ self.image.reshape(-1, 3).transpose()).\
-                transpose().reshape(self.image.shape)
-            self.displayed_image = self.to_display(np.fmin(img + m * 0.5, 1.0))
+            masks = masks.reshape(len(layers), *masks.shape[-2:]) > 0
+        logits = logits.reshape(len(layers), 1, *logits.shape[-2:])
+        for l, mask, mask_input in zip(layers, masks, logits):
+            l.mask = mask
+            l.mask_input = mask_input
+            l.stale = False
+            self.results.put(l.points, l.labels, mask, mask_input)
+
+    def update_display(self):
+        if self.image is not None:
+            self.show(self.mask, self.render(self.mask))
+
+    def set_display(self, image, mask, damage=None):
+        # damage is the region (x0, y0, x1, y1) of the displayed image that
+        # changed, None if all of it did; it is valid for the version
+        # following the previous one only
+        self.displayed_image = image
+        self.displayed_mask = mask
+        self.damage = damage
+        self.display_version += 1
+
+    def render(self, mask):
+        # the update of the displayed image that shows mask instead of the
+        # current one, as (current mask, rect, pixels): when the change is
+        # small, pixels covers only the rectangle that changed, otherwise
+        # the whole image (and rect is None)
+        prev = self.displayed_mask
+        if mask is not None and prev is not None \
+           and prev.shape == mask.shape:
+            with tracing.span('damage'):
+                rect = changed_rect(prev, mask)
+            x0, y0, x1, y1 = rect
+            if (x1 - x0) * (y1 - y0) <= self.max_damage * mask.size:
+                return prev, rect, self.composite(mask[y0:y1, x0:x1], rect)
+        return prev, None, self.composite(mask)
+
+    def show(self, mask, update):
+        # applies an update from render(); the displayed image is patched
+        # in place when the update was computed against the current mask,
+        # and is otherwise composited again
+        prev, rect, pixels = update
+        if rect is not None and prev is self.displayed_mask:
+            x0, y0, x1, y1 = rect
+            self.displayed_image[y0:y1, x0:x1] = pixels
+            self.set_display(self.displayed_image, mask, rect)
+        else:
+            if rect is not None:
+                pixels = self.composite(mask)
+            self.set_display(pixels, mask)
+
+    def composite(self, mask, rect=None):
+        # rect is the region of the image covered by mask, by default all
+        # of it
+        if mask is None:
+            return self.plain_image
+        base, tinted = self.get_overlay()
+        if rect is not None:
+            x0, y0, x1, y1 = rect
+            base = base[y0:y1, x0:x1]
+            tinted = tinted[y0:y1, x0:x1]
+        with tracing.span('composite'):
+            return np.where(mask[:, :, None], tinted, base)
+
+    def start_overlay(self):
+        # the overlay is built in the background while the image is being
+        # encoded, so that showing the first mask does not have to wait for
+        # the display colour transform
+        if self.overlay is None and self.image is not None:
+            self.overlay_future = self.overlay_pool.submit(self.make_overlay,
+                                                           self.image)
+
+    def get_overlay(self):
+        if self.overlay is None:
+            with tracing.span('overlay'):
+                if self.overlay_future is not None:
+                    self.overlay = self.overlay_future.result()
+                else:
+                    self.overlay = self.make_overlay(self.image)
+            self.overlay_future = None
+        return self.overlay
+
+    def make_overlay(self, image):
+        s = 0.5
+        w = [0.2225045 * (1-s),  0.7168786 * (1-s),  0.0606169 * (1-s)]
+        desat = np.array([
+            [w[0] + s, w[0], w[0]],
+            [w[1], w[1] + s, w[1]],
+            [w[2], w[2], w[2] + s]
+        ], dtype=np.float32) / 255.0
+        c = np.array(self.conf.mask_color, dtype=np.float32) / 255.0 * 0.5
+        base = np.empty(image.shape, dtype=np.uint8)
+        tinted = np.empty(image.shape, dtype=np.uint8)
+        # process in strips of about 1M pixels to bound the size of the
+        # temporary float buffers
+        height, width = image.shape[:2]
+        step = max(1, (1 << 20) // width)
+        for y in range(0, height, step):
+            img = image[y:y+step].reshape(-1, 3) @ desat
+            base[y:y+step] = (img * 255).reshape(-1, width, 3)
+            np.fmin(img + c, 1.0, out=img)
+            tinted[y:y+step] = (img * 255).reshape(-1, width, 3)
+        return self.to_display(base), self.to_display(tinted)
 
     def reset(self, clear_image):
-        self.saved = True
         self.points = []
         self.labels = []
+        self.redo_points = []
         self.mask = None
         self.mask_input = None
+        self.stale = False
+        self.saved = not any(l.points for l in self.layers)
         if clear_image:
+            self.saved = True
+            self.layers = [MaskLayer(self.default_layer)]
+            self.layer = self.layers[0]
             self.image = None
-            self.displayed_image = None
+            self.overlay = None
+            if self.overlay_future is not None:
+                self.overlay_future.cancel()
+                self.overlay_future = None
+            self.reduced = False
+            self.plain_image = None
+            self.set_display(None, None)
+            self.results.clear()
+            if self.predictor is not None:
+                self.predictor.reset_predictor()
         else:
-            self.displayed_image = self.to_display(self.image)
+            self.set_display(self.plain_image, None)
 
     def to_display(self, img):
-        ret = (img * 255).astype(np.uint8)
+        if img.dtype == np.uint8:
+            ret = img
+        else:
+            ret = (img * 255).astype(np.uint8)
         if self.display_xform is not None:
-            src = Image.fromarray(ret)
-            ImageCms.applyTransform(src, self.display_xform, True)
-            ret = np.array(src)
+            with tracing.span('display transform'):
+                src = Image.fromarray(ret)
+                ImageCms.applyTransform(src, self.display_xform, True)
+                ret = np.array(src)
         return ret
             
-    def undo_last(self):
+    def undo_last(self, predict=True):
         if self.points:
-            self.points.pop()
-            self.labels.pop()
-            self.saved = not self.points
-            self.predict()
+            self.redo_points.append((self.points.pop(), self.labels.pop()))
+            self.saved = not any(l.points for l in self.layers)
+            self.changed(predict)
+
+    def redo(self, predict=True):
+        if self.redo_points:
+            point, label = self.redo_points.pop()
+            self.points.append(point)
+            self.labels.append(label)
+            self.saved = False
+            self.changed(predict)
+
+    def mask_files(self, filename):
+        # the first layer is saved to filename, the others next to it
+        files = [filename] + [layer_filename(filename, l.name)
+                              for l in self.layers[1:]]
+        return list(zip(self.layers, files))
 
     def save_mask(self, filename):
+        self.save_layers(self.mask_files(filename))
+
+    def save_mask_async(self, filename, progress=None, done=None):
+        # the masks are written by a background thread; done(job) is called
+        # from that thread when finished, with job.error set on failure
+        job = self.save_job(self.mask_files(filename))
+        self.saved = True
+        self.saver.submit(job, progress, done)
+        return job
+
+    def save_layers(self, items, names=None):
+        # items is a list of (layer, filename)
+        self.write_masks(self.save_job(items, names))
+        self.saved = True
+
+    def save_job(self, items, names=None):
         if self.image is None:
             raise Exception("no image loaded")
-        if self.mask is not None:
-            mask = (self.mask * 255).astype(np.uint8)
-        else:
-            mask = np.zeros_like(self.image)
-        img = Image.fromarray((self.mask * 255).astype(np.uint8))
-        img.save(filename)
-        data = {
-            'image' : self.image_filename,
-            'sha256sum' : checksum(self.image_filename),
-            'points' : self.points,
-            'labels' : self.labels,
-        }
-        if self.conf.exiftool:
-            subprocess.run([
-                self.conf.exiftool,
-                '-config',
-                os.path.join(os.path.dirname(__file__),
-                             '../data/exiftool.config'),
-                '-overwrite_original',
-                '-Smart_mask_data=' + json.dumps(data),
-                filename], capture_output=True)
-        self.saved = True
+        with self.lock:
+            self.flush_predictions()
+            return SaveJob(self, items, names)
+
+    def write_masks(self, job, progress=None):
+        # the metadata of each mask records the names of all the files
+        # saved together, so that they can be reopened at once
+        if progress is None:
+            progress = _no_progress
+        with tracing.span('save'):
+            progress('checksum', 'computing the image checksum...')
+            with tracing.span('checksum'):
+                sha256sum = self.checksum(job.image_filename)
+            tags = []
+            for i, (layer, filename) in enumerate(job.items):
+                progress('png', f'writing mask {i+1}/{len(job.items)}...')
+                with tracing.span('png encode'):
+                    mask = full_mask(layer, job.size, job.scale)
+                    pnginfo = None
+                    if layer.mask_input is not None:
+                        pnginfo = PngImagePlugin.PngInfo()
+                        pnginfo.add_text(LOGITS_KEY,
+                                         encode_logits(layer.mask_input))
+                    Image.fromarray(mask).save(
+                        filename, pnginfo=pnginfo,
+                        compress_level=self.conf.png_compress_level)
+                    del mask
+                data = {
+                    'image' : job.image_filename,
+                    'sha256sum' : sha256sum,
+                    'points' : layer.points,
+                    'labels' : layer.labels,
+                    'model' : job.model,
+                    'layer' : layer.name,
+                    'layers' : job.names,
+                }
+                data.update(job.data)
+                tags.append((filename, {'Smart_mask_data': json.dumps(data)}))
+            if self.exiftool is not None:
+                progress('metadata', 'writing metadata...')
+                with tracing.span('exiftool'):
+                    res = self.exiftool.write_tags(tags)
+                errors = [f'{fn}: {line}'
+                          for ((fn, _), err) in zip(tags, res)
+                          for line in err.splitlines()
+                          if line.startswith('Error')]
+                if errors:
+                    raise exiftool.ExifToolError('\n'.join(errors))
 
 # end of class AIMaskingEngine
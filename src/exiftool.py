@@ -0,0 +1,163 @@
+import os
+import json
+import queue
+import atexit
+import threading
+import subprocess
+
+CONFIG = os.path.join(os.path.dirname(__file__), '../data/exiftool.config')
+
+
+class ExifToolError(Exception):
+    pass
+
+
+class ExifTool:
+    def __init__(self, executable, config=CONFIG, timeout=60):
+        self.executable = executable
+        self.config = config
+        # seconds to wait for the answer to a command before restarting
+        # exiftool
+        self.timeout = timeout
+        self.proc = None
+        self.output = None
+        self.seq = 0
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    @staticmethod
+    def from_config(conf):
+        if conf.exiftool:
+            return ExifTool(conf.exiftool, timeout=conf.exiftool_timeout)
+        return None
+
+    def start(self):
+        cmd = [self.executable]
+        if self.config:
+            # -config is only honoured as the first command-line option
+            cmd += ['-config', self.config]
+        cmd += ['-stay_open', 'True', '-@', '-']
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+        # both pipes are drained by threads, so that exiftool never blocks
+        # on a full pipe while we wait on the other one, and reads can time
+        # out
+        self.output = (queue.Queue(), queue.Queue())
+        for stream, lines in zip((self.proc.stdout, self.proc.stderr),
+                                 self.output):
+            threading.Thread(target=self._reader, args=(stream, lines),
+                             daemon=True).start()
+
+    @staticmethod
+    def _reader(stream, lines):
+        try:
+            for line in iter(stream.readline, b''):
+                lines.put(line)
+        except (OSError, ValueError):
+            pass
+        lines.put(None)
+
+    def close(self):
+        locked = self.lock.acquire(timeout=5)
+        try:
+            if self.proc is not None and locked:
+                try:
+                    self.proc.stdin.write(b'-stay_open\nFalse\n')
+                    self.proc.stdin.close()
+                    self.proc.wait(timeout=5)
+                    self.proc = None
+                except Exception:
+                    pass
+            self._kill()
+        finally:
+            if locked:
+                self.lock.release()
+
+    def _kill(self):
+        if self.proc is not None:
+            try:
+                self.proc.kill()
+                self.proc.wait()
+            except OSError:
+                pass
+            self.proc = None
+
+    def execute(self, args):
+        return self.execute_many([args])[0]
+
+    def execute_many(self, commands):
+        # all the commands are sent in one go and the answers collected
+        # afterwards, so that exiftool can process them back to back.
+        # The process is restarted (once) if it died or does not answer
+        # within the timeout
+        for args in commands:
+            for a in args:
+                if '\n' in a:
+                    raise ValueError('invalid argument: ' + repr(a))
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.proc is None or self.proc.poll() is not None:
+                        self.start()
+                    return self._execute(commands)
+                except (OSError, EOFError, TimeoutError) as e:
+                    self._kill()
+                    if attempt:
+                        raise ExifToolError(f'exiftool failed: {e}')
+
+    def _execute(self, commands):
+        data = []
+        seqs = []
+        for args in commands:
+            self.seq += 1
+            seqs.append(self.seq)
+            data += list(args)
+            data += ['-echo4', f'{{ready{self.seq}}}', f'-execute{self.seq}']
+        self.proc.stdin.write(('\n'.join(data) + '\n').encode('utf-8'))
+        self.proc.stdin.flush()
+        res = []
+        for n in seqs:
+            out = self._read(self.output[0], n)
+            err = self._read(self.output[1], n)
+            res.append((out, err))
+        return res
+
+    def _read(self, output, n):
+        sentinel = f'{{ready{n}}}'.encode('utf-8')
+        lines = []
+        while True:
+            try:
+                line = output.get(timeout=self.timeout)
+            except queue.Empty:
+                raise TimeoutError(f'no answer in {self.timeout} s')
+            if line is None:
+                raise EOFError('unexpected end of output')
+            if line.rstrip(b'\r\n') == sentinel:
+                break
+            lines.append(line)
+        return b''.join(lines).decode('utf-8', errors='replace')
+
+    def read_tags(self, filenames, tags):
+        if not filenames:
+            return []
+        out, err = self.execute(['-json'] + ['-' + t for t in tags] +
+                                list(filenames))
+        key = lambda fn: os.path.normcase(os.path.normpath(fn))
+        found = {}
+        try:
+            for md in json.loads(out):
+                found[key(md.get('SourceFile', ''))] = md
+        except ValueError:
+            pass
+        return [found.get(key(fn), {}) for fn in filenames]
+
+    def write_tags(self, items):
+        commands = []
+        for filename, tags in items:
+            commands.append(['-overwrite_original'] +
+                            [f'-{t}={v}' for (t, v) in tags.items()] +
+                            [filename])
+        return [err for (out, err) in self.execute_many(commands)]
+
+# end of class ExifTool
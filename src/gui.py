@@ -1,68 +1,380 @@
 import wx
 import os
+import re
+import math
+import sys
+import time
+import bisect
+import threading
+import numpy as np
 from pathlib import Path
 from PIL import Image
 
 import config
 import engine
+import tracing
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff')
+
+
+def list_images(directory):
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return sorted(os.path.abspath(os.path.join(directory, n)) for n in names
+                  if os.path.splitext(n)[1].lower() in IMAGE_EXTENSIONS
+                  and not n.endswith('_mask.png'))
+
+
+def neighbours(images, path, direction):
+    # the images after (direction > 0) or before path in the sorted list
+    # images, nearest first; path does not have to be in the list
+    if path is None:
+        return images if direction > 0 else images[::-1]
+    i = bisect.bisect_left(images, path)
+    if direction > 0:
+        if i < len(images) and images[i] == path:
+            i += 1
+        return images[i:]
+    return images[:i][::-1]
+
+
+class StartupTimings:
+    def __init__(self, start=None, enabled=False):
+        self.start = time.perf_counter() if start is None else start
+        self.enabled = enabled
+        self.seen = set()
+
+    def mark(self, event):
+        if self.enabled and event not in self.seen:
+            self.seen.add(event)
+            t = time.perf_counter() - self.start
+            print(f'{event}: {t:.3f} s', file=sys.stderr)
+
+# end of class StartupTimings
+
 
 class ImagePanel(wx.Panel):
-    def __init__(self, parent, engine):
+    def __init__(self, parent, engine, timings):
         super().__init__(parent)
         self.image = None
-        self.bitmap = None
+        self.wx_image = None
+        self.mipmaps = []
+        self.scaled = None
+        self.display_version = None
         self.zoom = 1.0
         self.offset_x = 0
         self.offset_y = 0
         self.dragging = False
         self.drag_start = (0, 0)
         self.engine = engine
+        self.timings = timings
+        self.ready = False
+        self.load_cancelled = None
+        self.preview = None
+        self.preview_scaled = None
+        self.preview_enabled = engine.conf.hover_preview
+        self.preview_busy = False
+        self.preview_next = None
+        self.preview_generation = 0
+        self.preview_latency = None
+        self.preview_samples = 0
 
         self.Bind(wx.EVT_PAINT, self.on_paint)
         self.Bind(wx.EVT_LEFT_DOWN, self.on_left_down)
         self.Bind(wx.EVT_LEFT_UP, self.on_left_up)
         self.Bind(wx.EVT_RIGHT_DOWN, self.on_right_down)
         self.Bind(wx.EVT_MOTION, self.on_motion)
+        self.Bind(wx.EVT_LEAVE_WINDOW, self.on_leave)
         self.Bind(wx.EVT_MOUSEWHEEL, self.on_mousewheel)
         self.SetBackgroundColour(
             wx.Colour(*self.engine.conf.background_color))
 
-    def load_image(self, path):
-        self.engine.load_image(path)
-        self.image = self.engine.displayed_image
+    def load_image(self, path, progress, done):
+        if self.load_cancelled is not None:
+            self.load_cancelled.set()
+        cancelled = threading.Event()
+        self.load_cancelled = cancelled
+        self.ready = False
+        self.image = None
         self.update_bitmap()
-        self.center_image()
-        self.zoom_fit()
+        self.Refresh()
+
+        def on_progress(stage, msg, img):
+            if cancelled.is_set():
+                return
+            if img is not None:
+                self.image = img
+                self.update_bitmap()
+                self.center_image()
+                self.zoom_fit()
+            if msg:
+                progress(msg)
+
+        def on_done(err):
+            if cancelled.is_set():
+                return
+            self.load_cancelled = None
+            if err is None:
+                self.ready = True
+                self.show_displayed()
+                self.Refresh()
+            done(err)
+
+        def on_refined():
+            if not cancelled.is_set():
+                self.refresh_image(self.show_displayed())
+
+        def notify(stage, msg):
+            img = self.engine.displayed_image if stage == 'decoded' else None
+            wx.CallAfter(on_progress, stage, msg, img)
+
+        def work():
+            try:
+                self.engine.load_image(path, notify, cancelled.is_set)
+                err = None
+            except engine.LoadCancelled:
+                return
+            except Exception as e:
+                err = e
+            wx.CallAfter(on_done, err)
+            # images opened from a quick draft are decoded again at the
+            # preview size, while the user can already work on them
+            if err is None and not cancelled.is_set() \
+               and self.engine.refine_image():
+                wx.CallAfter(on_refined)
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def show_displayed(self):
+        # takes the displayed image of the engine, and returns the region
+        # that changed since the last one (None if unknown or everything)
+        rect = None
+        if self.engine.damage is not None and self.preview is None \
+           and self.display_version == self.engine.display_version - 1:
+            rect = self.engine.damage
+        self.display_version = self.engine.display_version
+        self.image = self.engine.displayed_image
+        self.update_bitmap(rect)
+        return rect
+
+    def refresh_image(self, rect):
+        # repaints the part of the panel showing the region rect of the
+        # image, or all of it if rect is None
+        if rect is None or not self.wx_image:
+            self.Refresh()
+            return
+        x0, y0, x1, y1 = rect
+        if x1 <= x0 or y1 <= y0:
+            return
+        # with a margin for the resampling filter
+        m = 2 + int(self.zoom)
+        sx0 = int(self.offset_x + x0 * self.zoom) - m
+        sy0 = int(self.offset_y + y0 * self.zoom) - m
+        sx1 = int(math.ceil(self.offset_x + x1 * self.zoom)) + m
+        sy1 = int(math.ceil(self.offset_y + y1 * self.zoom)) + m
+        self.RefreshRect(wx.Rect(sx0, sy0, sx1 - sx0, sy1 - sy0), False)
 
-    def update_bitmap(self):
+    def update_bitmap(self, rect=None):
+        # rect is the region of the image that changed since the last
+        # update, if known: only that part of the bitmaps is updated
+        if rect is not None and self.wx_image and self.image is not None \
+           and self.image.shape[:2] == self.image_size()[::-1]:
+            with tracing.span('update bitmap'):
+                self.patch_bitmap(rect)
+            self.clear_preview()
+            return
         if self.image is not None:
-            h, w = self.image.shape[:2]
-            wx_image = wx.Image(w, h)
-            wx_image.SetData(self.image.tobytes())
-            self.bitmap = wx.Bitmap(wx_image)
+            with tracing.span('update bitmap'):
+                h, w = self.image.shape[:2]
+                # the same image at another resolution (see
+                # AIMaskingEngine.refine_image) stays where it was
+                if self.wx_image:
+                    self.zoom *= self.image_size()[0] / w
+                self.wx_image = wx.Image(w, h)
+                self.wx_image.SetData(self.image.tobytes())
         else:
-            self.bitmap = None
+            self.wx_image = None
+        self.mipmaps = [self.wx_image] if self.wx_image else []
+        self.scaled = None
+        self.clear_preview()
+
+    def image_size(self):
+        return self.wx_image.GetWidth(), self.wx_image.GetHeight()
 
     def center_image(self):
-        if self.bitmap:
+        if self.wx_image:
             panel_w, panel_h = self.GetSize()
-            img_w = int(self.bitmap.GetWidth() * self.zoom)
-            img_h = int(self.bitmap.GetHeight() * self.zoom)
-            self.offset_x = (panel_w - img_w) // 2
-            self.offset_y = (panel_h - img_h) // 2
+            img_w, img_h = self.image_size()
+            self.offset_x = (panel_w - int(img_w * self.zoom)) // 2
+            self.offset_y = (panel_h - int(img_h * self.zoom)) // 2
+
+    def patch_bitmap(self, rect):
+        x0, y0, x1, y1 = rect
+        if x1 <= x0 or y1 <= y0:
+            return
+        h, w = self.image.shape[:2]
+        data = np.frombuffer(self.wx_image.GetDataBuffer(), dtype=np.uint8)
+        data = data.reshape(h, w, 3)
+        data[y0:y1, x0:x1] = self.image[y0:y1, x0:x1]
+        # each mipmap is the previous one shrunk by 2, so the pixels that
+        # changed are recomputed from the 2x2 blocks covering them
+        for level in range(1, len(self.mipmaps)):
+            img = self.mipmaps[level]
+            x0, y0 = x0 // 2, y0 // 2
+            x1 = min((x1 + 1) // 2, img.GetWidth())
+            y1 = min((y1 + 1) // 2, img.GetHeight())
+            if x1 <= x0 or y1 <= y0:
+                break
+            src = self.mipmaps[level - 1].GetSubImage(
+                wx.Rect(2 * x0, 2 * y0, 2 * (x1 - x0), 2 * (y1 - y0)))
+            img.Paste(src.ShrinkBy(2, 2), x0, y0)
+        if self.scaled is not None:
+            with tracing.span('scale'):
+                self.patch_scaled(rect)
+
+    def patch_scaled(self, rect):
+        # scales again the part of the cached bitmap showing rect
+        zoom, bmp, (bx, by), area = self.scaled
+        img_w, _ = self.image_size()
+        level, src = self.get_mipmap(self.mipmap_level(zoom))
+        f = src.GetWidth() / img_w
+        z = zoom / f
+        rx0 = max(int(rect[0] * f), area[0])
+        ry0 = max(int(rect[1] * f), area[1])
+        rx1 = min(int(math.ceil(rect[2] * f)), area[2])
+        ry1 = min(int(math.ceil(rect[3] * f)), area[3])
+        if rx1 <= rx0 or ry1 <= ry0:
+            return
+        # the region is scaled with a margin, which is then dropped, so
+        # that the filter sees the same pixels as when scaling everything
+        m = 2
+        mx0, my0 = max(rx0 - m, area[0]), max(ry0 - m, area[1])
+        mx1, my1 = min(rx1 + m, area[2]), min(ry1 + m, area[3])
+        ox, oy = int(round(mx0 * z)), int(round(my0 * z))
+        img = src.GetSubImage(wx.Rect(mx0, my0, mx1 - mx0, my1 - my0))
+        img = img.Scale(max(int(round(mx1 * z)) - ox, 1),
+                        max(int(round(my1 * z)) - oy, 1),
+                        wx.IMAGE_QUALITY_HIGH)
+        ix0, iy0 = int(round(rx0 * z)), int(round(ry0 * z))
+        ix1 = min(int(round(rx1 * z)), ox + img.GetWidth())
+        iy1 = min(int(round(ry1 * z)), oy + img.GetHeight())
+        if ix1 <= ix0 or iy1 <= iy0:
+            return
+        img = img.GetSubImage(wx.Rect(ix0 - ox, iy0 - oy,
+                                      ix1 - ix0, iy1 - iy0))
+        dc = wx.MemoryDC(bmp)
+        dc.DrawBitmap(wx.Bitmap(img), ix0 - bx, iy0 - by)
+        dc.SelectObject(wx.NullBitmap)
+
+    def mipmap_level(self, zoom):
+        level = 0
+        while zoom * (1 << (level + 1)) <= 1:
+            level += 1
+        return level
+
+    def get_mipmap(self, level):
+        while len(self.mipmaps) <= level:
+            img = self.mipmaps[-1]
+            if img.GetWidth() < 2 or img.GetHeight() < 2:
+                return len(self.mipmaps) - 1, img
+            self.mipmaps.append(img.ShrinkBy(2, 2))
+        return level, self.mipmaps[level]
+
+    def get_scaled_bitmap(self):
+        # returns a bitmap of (a region of) the image at the current zoom
+        # level, together with its position in zoomed image coordinates.
+        # The bitmap is cached until the zoom or the image change; when
+        # the zoomed image is much larger than the panel, only the visible
+        # part (plus a margin, so that panning is just a blit) is scaled
+        img_w, img_h = self.image_size()
+        zoom = self.zoom
+        w, h = max(int(img_w * zoom), 1), max(int(img_h * zoom), 1)
+        panel_w, panel_h = self.GetClientSize()
+        if w * h <= 4 * panel_w * panel_h:
+            want = (0, 0, w, h)
+        else:
+            x0 = max(-int(self.offset_x), 0)
+            y0 = max(-int(self.offset_y), 0)
+            x1 = min(panel_w - int(self.offset_x), w)
+            y1 = min(panel_h - int(self.offset_y), h)
+            if x1 <= x0 or y1 <= y0:
+                return None, None
+            want = (x0, y0, x1, y1)
+        if self.scaled is not None:
+            key, bmp, (bx, by), _ = self.scaled
+            if key == zoom and bx <= want[0] and by <= want[1] \
+               and bx + bmp.GetWidth() >= want[2] \
+               and by + bmp.GetHeight() >= want[3]:
+                return bmp, (bx, by)
+        if want != (0, 0, w, h):
+            mx, my = panel_w // 2, panel_h // 2
+            want = (max(want[0] - mx, 0), max(want[1] - my, 0),
+                    min(want[2] + mx, w), min(want[3] + my, h))
+        level, src = self.get_mipmap(self.mipmap_level(zoom))
+        f = src.GetWidth() / img_w
+        z = zoom / f
+        sx0 = int(want[0] / z)
+        sy0 = int(want[1] / z)
+        sx1 = min(int(want[2] / z + 1), src.GetWidth())
+        sy1 = min(int(want[3] / z + 1), src.GetHeight())
+        if (sx0, sy0, sx1, sy1) != (0, 0, src.GetWidth(), src.GetHeight()):
+            src = src.GetSubImage(wx.Rect(sx0, sy0, sx1 - sx0, sy1 - sy0))
+        bx, by = int(round(sx0 * z)), int(round(sy0 * z))
+        bw = max(int(round(sx1 * z)) - bx, 1)
+        bh = max(int(round(sy1 * z)) - by, 1)
+        with tracing.span('scale'):
+            bmp = wx.Bitmap(src.Scale(bw, bh, wx.IMAGE_QUALITY_HIGH))
+        self.scaled = (zoom, bmp, (bx, by), (sx0, sy0, sx1, sy1))
+        return bmp, (bx, by)
+
+    def get_preview_bitmap(self):
+        # the visible part of the hover preview scaled to the current zoom,
+        # and its position on screen
+        img_w, img_h = self.image_size()
+        w, h = img_w * self.zoom, img_h * self.zoom
+        panel_w, panel_h = self.GetClientSize()
+        key = (self.zoom, int(self.offset_x), int(self.offset_y),
+               panel_w, panel_h)
+        if self.preview_scaled is not None and self.preview_scaled[0] == key:
+            return self.preview_scaled[1:]
+        x0, y0 = max(-self.offset_x, 0), max(-self.offset_y, 0)
+        x1 = min(panel_w - self.offset_x, w)
+        y1 = min(panel_h - self.offset_y, h)
+        if x1 <= x0 or y1 <= y0:
+            return None, None
+        pw, ph = self.preview.GetWidth(), self.preview.GetHeight()
+        sx0, sy0 = int(x0 * pw / w), int(y0 * ph / h)
+        sx1 = min(int(x1 * pw / w) + 1, pw)
+        sy1 = min(int(y1 * ph / h) + 1, ph)
+        src = self.preview.GetSubImage(wx.Rect(sx0, sy0, sx1 - sx0, sy1 - sy0))
+        bx = int(round(sx0 * w / pw + self.offset_x))
+        by = int(round(sy0 * h / ph + self.offset_y))
+        bw = max(int(round(sx1 * w / pw + self.offset_x)) - bx, 1)
+        bh = max(int(round(sy1 * h / ph + self.offset_y)) - by, 1)
+        bmp = wx.Bitmap(src.Scale(bw, bh, wx.IMAGE_QUALITY_BILINEAR))
+        self.preview_scaled = (key, bmp, (bx, by))
+        return bmp, (bx, by)
 
     def on_paint(self, event):
+        with tracing.span('paint'):
+            self.paint()
+
+    def paint(self):
         dc = wx.BufferedPaintDC(self)
+        dc.SetClippingRegion(self.GetUpdateRegion().GetBox())
         dc.Clear()
-        if self.bitmap:
-            w = int(self.bitmap.GetWidth() * self.zoom)
-            h = int(self.bitmap.GetHeight() * self.zoom)
-            scaled = self.bitmap.ConvertToImage().Scale(w, h,
-                                                        wx.IMAGE_QUALITY_HIGH)
-            bmp = wx.Bitmap(scaled)
-            x = int(self.offset_x)
-            y = int(self.offset_y)
-            dc.DrawBitmap(bmp, x, y, True)
+        if self.wx_image:
+            bmp, pos = self.get_scaled_bitmap()
+            if bmp is not None:
+                x = int(self.offset_x) + pos[0]
+                y = int(self.offset_y) + pos[1]
+                dc.DrawBitmap(bmp, x, y, False)
+            if self.preview is not None:
+                bmp, pos = self.get_preview_bitmap()
+                if bmp is not None:
+                    dc.DrawBitmap(bmp, pos[0], pos[1], True)
 
             dc.SetPen(wx.Pen(wx.Colour(0, 0, 0), width=1))
             radius = 4
@@ -81,12 +393,8 @@ class ImagePanel(wx.Panel):
                 self.dragging = True
                 self.drag_start = (event.GetX(), event.GetY())
                 self.CaptureMouse()
-            else:
-                self.engine.add_point(
-                    self.to_image_coords(event.GetX(), event.GetY()), True)
-                self.image = self.engine.displayed_image
-                self.update_bitmap()
-                self.Refresh()
+            elif self.ready:
+                self.add_point(event, True)
 
     def on_left_up(self, event):
         if self.image is not None and self.dragging:
@@ -97,13 +405,36 @@ class ImagePanel(wx.Panel):
             self.Refresh()
 
     def on_right_down(self, event):
-        if self.image is not None and not self._panning():
-            self.engine.add_point(
-                self.to_image_coords(event.GetX(), event.GetY()), False)
-            self.image = self.engine.displayed_image
-            self.update_bitmap()
-            self.Refresh()
-            
+        if self.ready and not self._panning():
+            self.add_point(event, False)
+
+    def add_point(self, event, is_positive):
+        # the point is shown right away, and the mask when it is ready
+        self.engine.add_point(
+            self.to_image_coords(event.GetX(), event.GetY()), is_positive,
+            predict=False)
+        self.clear_preview()
+        self.Refresh()
+        self.predict()
+
+    def predict(self):
+        # the mask of the current layer is computed by the prediction
+        # worker, and shown by on_prediction()
+        self.engine.predict_async(
+            lambda apply, err: wx.CallAfter(self.on_prediction, apply, err))
+
+    def on_prediction(self, apply, err):
+        if err is not None:
+            wx.MessageDialog(self, f"Error computing the mask:\n{err}",
+                             "Error", wx.OK | wx.ICON_ERROR).ShowModal()
+            return
+        with tracing.span('show mask'):
+            if not apply():
+                return
+            self.timings.mark('first mask')
+            rect = self.show_displayed()
+        self.refresh_image(rect)
+
     def on_motion(self, event):
         if self.dragging and event.Dragging() and event.LeftIsDown():
             dx = event.GetX() - self.drag_start[0]
@@ -112,6 +443,79 @@ class ImagePanel(wx.Panel):
             self.offset_y += dy
             self.drag_start = (event.GetX(), event.GetY())
             self.Refresh()
+        elif self.preview_enabled and self.ready and not self.dragging:
+            self.request_preview(
+                self.to_image_coords(event.GetX(), event.GetY()))
+
+    def on_leave(self, event):
+        if self.preview is not None:
+            self.clear_preview()
+            self.Refresh()
+
+    def clear_preview(self):
+        # drops the hover preview, and the results of pending requests
+        self.preview = None
+        self.preview_scaled = None
+        self.preview_next = None
+        self.preview_generation += 1
+
+    def toggle_preview(self):
+        self.preview_enabled = not self.preview_enabled
+        self.preview_latency = None
+        self.preview_samples = 0
+        self.clear_preview()
+        self.Refresh()
+        return self.preview_enabled
+
+    def request_preview(self, p):
+        # at most one preview is computed at a time, so that the rate of
+        # the requests follows the decoder latency; the last position seen
+        # while one is computed is previewed next
+        w, h = self.engine.get_size()
+        if not (0 <= p[0] < w and 0 <= p[1] < h):
+            self.on_leave(None)
+        elif self.preview_busy:
+            self.preview_next = p
+        else:
+            self.preview_busy = True
+            generation = self.preview_generation
+            start = time.perf_counter()
+            self.engine.preview_async(
+                p, lambda mask, err: wx.CallAfter(
+                    self.on_preview, generation, start, mask, err))
+
+    def on_preview(self, generation, start, mask, err):
+        self.preview_busy = False
+        latency = time.perf_counter() - start
+        if self.preview_latency is None:
+            self.preview_latency = latency
+        else:
+            self.preview_latency = 0.7 * self.preview_latency + 0.3 * latency
+        self.preview_samples += 1
+        if not self.preview_enabled or err is not None:
+            return
+        budget = self.engine.conf.hover_preview_budget
+        if budget > 0 and self.preview_samples >= 3 \
+           and self.preview_latency * 1000 > budget:
+            self.toggle_preview()
+            wx.GetTopLevelParent(self).SetStatusText(
+                f"hover preview disabled: the mask takes "
+                f"{self.preview_latency * 1000:.0f} ms to compute")
+            return
+        if generation == self.preview_generation and mask is not None:
+            h, w = mask.shape
+            color = np.array(self.engine.conf.mask_color[:3])
+            rgb = np.empty((h, w, 3), dtype=np.uint8)
+            rgb[...] = (color + 255) // 2
+            self.preview = wx.Image(w, h)
+            self.preview.SetData(rgb.tobytes())
+            self.preview.SetAlpha((mask * np.uint8(96)).tobytes())
+            self.preview_scaled = None
+            self.Refresh()
+        p = self.preview_next
+        if p is not None:
+            self.preview_next = None
+            self.request_preview(p)
 
     def on_mousewheel(self, event):
         rotation = event.GetWheelRotation()
@@ -138,9 +542,9 @@ class ImagePanel(wx.Panel):
         self.Refresh()
 
     def zoom_fit(self, event=None):
-        if self.bitmap:
+        if self.wx_image:
             panel_w, panel_h = self.GetSize()
-            img_w, img_h = self.bitmap.GetWidth(), self.bitmap.GetHeight()
+            img_w, img_h = self.image_size()
             scale_w = panel_w / img_w
             scale_h = panel_h / img_h
             self.zoom = min(scale_w, scale_h)
@@ -149,20 +553,47 @@ class ImagePanel(wx.Panel):
             self.Refresh()
 
     def reset(self, clear_image=False):
-        self.engine.reset(clear_image)
-        self.image = self.engine.displayed_image
-        self.update_bitmap()
-        self.Refresh()
+        if clear_image:
+            self.ready = False
+        with tracing.span('reset'):
+            self.engine.reset(clear_image)
+            rect = self.show_displayed()
+        self.refresh_image(rect)
 
     def undo(self):
-        self.engine.undo_last()
-        self.image = self.engine.displayed_image
-        self.update_bitmap()
-        self.Refresh()        
+        with tracing.span('undo'):
+            self.engine.undo_last(predict=False)
+        self.clear_preview()
+        self.Refresh()
+        self.predict()
+
+    def redo(self):
+        with tracing.span('redo'):
+            self.engine.redo(predict=False)
+        self.clear_preview()
+        self.Refresh()
+        self.predict()
+
+    def add_layer(self, name):
+        self.engine.add_layer(name)
+        self.refresh_image(self.show_displayed())
+
+    def select_layer(self, index):
+        self.engine.select_layer(index)
+        self.refresh_image(self.show_displayed())
+        # the prediction of the mask of the layer may have been superseded
+        # by one for another layer
+        if self.engine.stale:
+            self.predict()
+
+    def remove_layer(self, index):
+        self.engine.remove_layer(index)
+        self.refresh_image(self.show_displayed())
 
     def to_image_coords(self, x, y):
-        w = self.bitmap.GetWidth() * self.zoom
-        h = self.bitmap.GetHeight() * self.zoom
+        img_w, img_h = self.image_size()
+        w = img_w * self.zoom
+        h = img_h * self.zoom
         real_w, real_h = self.engine.get_size()
         scale_w = real_w / w
         scale_h = real_h / h
@@ -170,8 +601,9 @@ class ImagePanel(wx.Panel):
                 int(round((y - self.offset_y) * scale_h)))
 
     def to_screen_coords(self, x, y):
-        w = self.bitmap.GetWidth() * self.zoom
-        h = self.bitmap.GetHeight() * self.zoom
+        img_w, img_h = self.image_size()
+        w = img_w * self.zoom
+        h = img_h * self.zoom
         real_w, real_h = self.engine.get_size()
         scale_w = real_w / w
         scale_h = real_h / h
@@ -182,7 +614,9 @@ class ImagePanel(wx.Panel):
 
 
 class MainFrame(wx.Frame):
-    def __init__(self, conf, engine):
+    READOUT_OPERATIONS = ('load', 'predict', 'undo', 'redo', 'reset', 'save')
+
+    def __init__(self, conf, engine, timings=None):
         super().__init__(None, title="SMART AI mask builder - v" +
                          config.version,
                          size=conf.window_size)
@@ -195,12 +629,22 @@ class MainFrame(wx.Frame):
 
         self.engine = engine
         self.filename = None
+        self.current_path = None
+        self.direction = 1
+        self.timings = timings if timings is not None else StartupTimings()
 
         self.statusbar = self.CreateStatusBar()
         msg = "shift+left click: add positive point; " \
             "shift+right click: add negative point   "
         msg_size = self.statusbar.GetTextExtent(msg)
-        self.statusbar.SetFieldsCount(2, [-1, msg_size.width])
+        if tracing.tracer.readout:
+            self.statusbar.SetFieldsCount(3, [-1, msg_size.width, -1])
+            self.last_operation = ''
+            self.last_paint = ''
+            tracing.tracer.add_listener(
+                lambda *op: wx.CallAfter(self.show_timing, *op))
+        else:
+            self.statusbar.SetFieldsCount(2, [-1, msg_size.width])
         self.statusbar.SetStatusText("Ready")
         self.statusbar.SetStatusText(msg, 1)
 
@@ -229,12 +673,30 @@ class MainFrame(wx.Frame):
         tb_save = toolbar.AddTool(
             wx.ID_SAVE, "Save", svg('save.svg'),
             shortHelp="Save mask...")
+        tb_prev = toolbar.AddTool(
+            wx.ID_ANY, "Previous", svg('go-previous.svg'),
+            shortHelp="Open previous image in the directory")
+        tb_next = toolbar.AddTool(
+            wx.ID_ANY, "Next", svg('go-next.svg'),
+            shortHelp="Open next image in the directory")
         tb_reset = toolbar.AddTool(
             wx.ID_ANY, "Reset", svg('undo-all.svg'),
             shortHelp="Remove all points")
         tb_undo = toolbar.AddTool(
             wx.ID_ANY, "Undo", svg('undo.svg'),
             shortHelp="Remove last added point")
+        tb_redo = toolbar.AddTool(
+            wx.ID_ANY, "Redo", svg('redo.svg'),
+            shortHelp="Add back last removed point")
+        tb_layer_add = toolbar.AddTool(
+            wx.ID_ANY, "Add layer", svg('layer-add.svg'),
+            shortHelp="Add a new mask layer")
+        tb_layer_remove = toolbar.AddTool(
+            wx.ID_ANY, "Remove layer", svg('layer-remove.svg'),
+            shortHelp="Remove the current mask layer")
+        self.layer_choice = wx.Choice(toolbar, choices=[])
+        self.layer_choice.SetToolTip("Current mask layer")
+        toolbar.AddControl(self.layer_choice)
         tb_zoom_in = toolbar.AddTool(
             wx.ID_ZOOM_IN, "Zoom In", svg('magnifier-plus.svg'),
             shortHelp="Zoom in")
@@ -249,24 +711,36 @@ class MainFrame(wx.Frame):
             shortHelp="Zoom to fit")
         toolbar.Realize()
 
+        preview_id = wx.NewIdRef()
         accel_entries = [
             wx.AcceleratorEntry(wx.ACCEL_CTRL, ord('o'), tb_open.GetId()),
             wx.AcceleratorEntry(wx.ACCEL_CTRL, ord('s'), tb_save.GetId()),
+            wx.AcceleratorEntry(wx.ACCEL_NORMAL, wx.WXK_PAGEUP,
+                                tb_prev.GetId()),
+            wx.AcceleratorEntry(wx.ACCEL_NORMAL, wx.WXK_PAGEDOWN,
+                                tb_next.GetId()),
             wx.AcceleratorEntry(wx.ACCEL_CTRL, ord('z'), tb_undo.GetId()),
+            wx.AcceleratorEntry(wx.ACCEL_CTRL, ord('y'), tb_redo.GetId()),
+            wx.AcceleratorEntry(wx.ACCEL_CTRL | wx.ACCEL_SHIFT, ord('z'),
+                                tb_redo.GetId()),
             wx.AcceleratorEntry(wx.ACCEL_CTRL, ord('r'), tb_reset.GetId()),
             wx.AcceleratorEntry(wx.ACCEL_CTRL, ord('+'), tb_zoom_in.GetId()),
             wx.AcceleratorEntry(wx.ACCEL_CTRL, ord('='), tb_zoom_in.GetId()),
             wx.AcceleratorEntry(wx.ACCEL_CTRL, ord('-'), tb_zoom_out.GetId()),
             wx.AcceleratorEntry(wx.ACCEL_CTRL, ord('1'), tb_zoom_1_1.GetId()),
             wx.AcceleratorEntry(wx.ACCEL_CTRL, ord('f'), tb_zoom_fit.GetId()),
+            wx.AcceleratorEntry(wx.ACCEL_CTRL, ord('h'), preview_id),
         ]
         accel_table = wx.AcceleratorTable(accel_entries)
         self.SetAcceleratorTable(accel_table)
 
         self.Bind(wx.EVT_MENU, self.on_open_image, tb_open)
         self.Bind(wx.EVT_MENU, self.on_save, tb_save)
+        self.Bind(wx.EVT_MENU, self.on_prev_image, tb_prev)
+        self.Bind(wx.EVT_MENU, self.on_next_image, tb_next)
         self.Bind(wx.EVT_MENU, self.on_reset, tb_reset)
         self.Bind(wx.EVT_MENU, self.on_undo, tb_undo)
+        self.Bind(wx.EVT_MENU, self.on_redo, tb_redo)
         self.Bind(wx.EVT_MENU, self.panel_zoom_in, tb_zoom_in)
         self.Bind(wx.EVT_MENU, self.panel_zoom_out, tb_zoom_out)
         self.Bind(wx.EVT_MENU, self.panel_zoom_1_1, tb_zoom_1_1)
@@ -278,21 +752,79 @@ class MainFrame(wx.Frame):
         self.Bind(wx.EVT_TOOL, self.panel_zoom_1_1, tb_zoom_1_1)
         self.Bind(wx.EVT_TOOL, self.panel_zoom_fit, tb_zoom_fit)
         self.Bind(wx.EVT_TOOL, self.on_save, tb_save)
+        self.Bind(wx.EVT_TOOL, self.on_prev_image, tb_prev)
+        self.Bind(wx.EVT_TOOL, self.on_next_image, tb_next)
         self.Bind(wx.EVT_TOOL, self.on_reset, tb_reset)
         self.Bind(wx.EVT_TOOL, self.on_undo, tb_undo)
+        self.Bind(wx.EVT_TOOL, self.on_redo, tb_redo)
+        self.Bind(wx.EVT_TOOL, self.on_add_layer, tb_layer_add)
+        self.Bind(wx.EVT_TOOL, self.on_remove_layer, tb_layer_remove)
+        self.Bind(wx.EVT_CHOICE, self.on_select_layer, self.layer_choice)
+        self.Bind(wx.EVT_MENU, self.on_toggle_preview, id=preview_id)
 
         self.Bind(wx.EVT_MENU, self.on_close, id=wx.ID_EXIT)
         self.Bind(wx.EVT_CLOSE, self.on_close)
 
         hbox = wx.BoxSizer(wx.HORIZONTAL)
-        self.image_panel = ImagePanel(self, engine)
+        self.image_panel = ImagePanel(self, engine, self.timings)
         hbox.Add(self.image_panel, proportion=1, flag=wx.EXPAND)
 
         vbox.Add(hbox, proportion=1, flag=wx.EXPAND)
         self.SetSizer(vbox)
+        self.update_layers()
         self.Raise()
 
+    def load_model(self):
+        self.statusbar.SetStatusText("loading model...")
+        def done(err):
+            if err is None:
+                self.timings.mark('model ready')
+                if self.filename is None \
+                   and self.image_panel.load_cancelled is None:
+                    self.statusbar.SetStatusText("Ready")
+            else:
+                self.statusbar.SetStatusText("Error loading the model")
+                fn = config.Config.get_config_file()
+                wx.MessageDialog(self, f"Error loading the model:\n{err}\n"
+                                 "Please check your configuration file "
+                                 f"in {fn}", "Error",
+                                 wx.OK | wx.ICON_ERROR).ShowModal()
+        def work():
+            try:
+                self.engine.load_model()
+                err = None
+            except Exception as e:
+                import traceback
+                traceback.print_exc()
+                err = e
+            wx.CallAfter(done, err)
+        threading.Thread(target=work, daemon=True).start()
+
+    def show_timing(self, name, duration, children):
+        if name == 'paint':
+            self.last_paint = f'paint: {duration * 1000:.0f} ms'
+        elif name in self.READOUT_OPERATIONS:
+            self.last_operation = tracing.Tracer.format(name, duration,
+                                                        children)
+        else:
+            return
+        self.statusbar.SetStatusText(
+            '; '.join(t for t in (self.last_operation, self.last_paint) if t),
+            2)
+
+    def wait_saves(self):
+        # returns the save jobs that failed
+        if not self.engine.saver.pending():
+            return self.engine.saver.wait()
+        self.statusbar.SetStatusText("waiting for the mask to be saved...")
+        with wx.BusyCursor():
+            failed = self.engine.saver.wait()
+        # deliver the completion notifications
+        wx.SafeYield(self)
+        return failed
+
     def check_save(self):
+        self.wait_saves()
         if self.engine.saved:
             return True
         with wx.MessageDialog(self,
@@ -321,19 +853,55 @@ class MainFrame(wx.Frame):
                 return
             self.load_image(fd.GetPath())
 
+    def on_prev_image(self, event):
+        self.open_neighbour(-1)
+
+    def on_next_image(self, event):
+        self.open_neighbour(1)
+
+    def open_neighbour(self, direction):
+        images = neighbours(list_images(self.engine.conf.last_dir),
+                            self.current_path, direction)
+        if images:
+            self.direction = direction
+            self.load_image(images[0])
+        else:
+            self.statusbar.SetStatusText("No more images in the directory")
+
+    def prefetch_neighbours(self):
+        self.engine.prefetch_images(
+            neighbours(list_images(self.engine.conf.last_dir),
+                       self.current_path, self.direction))
+
     def load_image(self, path):
         if not self.check_save():
             return
-        try:
-            self.image_panel.load_image(path)
-            self.filename = Path(self.engine.image_filename)
-            self.statusbar.SetStatusText(f"loaded image: {self.filename}")
-            self.engine.conf.last_dir = os.path.dirname(path)
-        except Exception as e:
-            self.image_panel.reset(True)
-            wx.MessageDialog(self, f"Error loading image:\n{e}",
-                             "Load Error",
-                             wx.OK | wx.ICON_ERROR).ShowModal()        
+        self.filename = None
+        self.current_path = os.path.abspath(path)
+        self.statusbar.SetStatusText(f"loading image: {path}")
+        def progress(msg):
+            self.statusbar.SetStatusText(f"{path}: {msg}")
+        def done(err):
+            if err is None:
+                self.timings.mark('image loaded')
+                self.filename = Path(self.engine.image_filename)
+                self.statusbar.SetStatusText(
+                    f"loaded image: {self.filename} "
+                    f"({self.engine.memory_report()})")
+                # a mask file opens its source image, which is then the
+                # position in the directory
+                self.current_path = self.engine.image_filename
+                self.engine.conf.last_dir = os.path.dirname(
+                    self.current_path)
+                self.prefetch_neighbours()
+            else:
+                self.image_panel.reset(True)
+                self.statusbar.SetStatusText("Ready")
+                wx.MessageDialog(self, f"Error loading image:\n{err}",
+                                 "Load Error",
+                                 wx.OK | wx.ICON_ERROR).ShowModal()
+            self.update_layers()
+        self.image_panel.load_image(path, progress, done)
 
     def panel_zoom_in(self, event):
         self.image_panel.zoom_in()
@@ -360,28 +928,97 @@ class MainFrame(wx.Frame):
             if fd.ShowModal() == wx.ID_CANCEL:
                 return True
             path = fd.GetPath()
-            try:
-                self.engine.save_mask(path)
+        def progress(stage, msg):
+            wx.CallAfter(self.statusbar.SetStatusText, f"{path}: {msg}")
+        def done(job):
+            if job.error is None:
                 self.statusbar.SetStatusText(f"mask saved to {path}")
-                return True
-            except Exception as e:
-                wx.MessageDialog(self, f"Error saving mask:\n{e}",
+            else:
+                self.statusbar.SetStatusText("Error saving mask")
+                wx.MessageDialog(self, f"Error saving mask:\n{job.error}",
                                  "Save Error",
                                  wx.OK | wx.ICON_ERROR).ShowModal()
-                return False
+        try:
+            # masks still being computed are waited for, so that the saved
+            # masks match their points
+            if self.engine.flush_predictions():
+                self.image_panel.refresh_image(
+                    self.image_panel.show_displayed())
+            self.engine.save_mask_async(path, progress,
+                                        lambda job: wx.CallAfter(done, job))
+            self.statusbar.SetStatusText(f"saving mask to {path}...")
+            return True
+        except Exception as e:
+            wx.MessageDialog(self, f"Error saving mask:\n{e}",
+                             "Save Error",
+                             wx.OK | wx.ICON_ERROR).ShowModal()
+            return False
 
     def on_save(self, event):
         self.save_mask()
 
     def on_reset(self, event):
-        self.image_panel.reset()
+        if self.image_panel.ready:
+            self.image_panel.reset()
 
     def on_undo(self, event):
-        self.image_panel.undo()
+        if self.image_panel.ready:
+            self.image_panel.undo()
+
+    def on_redo(self, event):
+        if self.image_panel.ready:
+            self.image_panel.redo()
+
+    def on_toggle_preview(self, event):
+        if self.image_panel.toggle_preview():
+            self.statusbar.SetStatusText("hover preview on")
+        else:
+            self.statusbar.SetStatusText("hover preview off")
+
+    def update_layers(self):
+        self.layer_choice.Set([l.name for l in self.engine.layers])
+        self.layer_choice.SetSelection(
+            self.engine.layers.index(self.engine.layer))
+        self.layer_choice.InvalidateBestSize()
+        self.layer_choice.SetSize(self.layer_choice.GetBestSize())
+        self.GetToolBar().Realize()
+
+    def on_add_layer(self, event):
+        if not self.image_panel.ready:
+            return
+        with wx.TextEntryDialog(self, "Name of the new mask layer:",
+                                "Add layer",
+                                f"layer{len(self.engine.layers) + 1}") as dlg:
+            if dlg.ShowModal() != wx.ID_OK:
+                return
+            name = re.sub(r'[^\w-]+', '_', dlg.GetValue().strip())
+        if not name:
+            return
+        try:
+            self.image_panel.add_layer(name)
+        except ValueError as e:
+            wx.MessageDialog(self, str(e), "Add layer",
+                             wx.OK | wx.ICON_ERROR).ShowModal()
+        self.update_layers()
+
+    def on_remove_layer(self, event):
+        if self.image_panel.ready and len(self.engine.layers) > 1:
+            self.image_panel.remove_layer(
+                self.engine.layers.index(self.engine.layer))
+            self.update_layers()
+
+    def on_select_layer(self, event):
+        if self.image_panel.ready:
+            self.image_panel.select_layer(self.layer_choice.GetSelection())
+        self.update_layers()
 
     def on_close(self, event):
         if not self.check_save():
             return
+        # ask again if the last save failed
+        if self.wait_saves() and not self.check_save():
+            return
+        self.wait_saves()
         def update(cur, prev):
             a, b = prev
             na, nb = cur
@@ -398,7 +1035,8 @@ class MainFrame(wx.Frame):
 # end of class MainFrame
 
 
-def main(conf, filename=None):
+def main(conf, filename=None, start_time=None, show_timings=False):
+    timings = StartupTimings(start_time, show_timings)
     app = wx.PyApp() if wx.Platform == '__WXMAC__' else wx.App()
     fn = config.Config.get_config_file()
     if not os.path.exists(fn):
@@ -409,7 +1047,9 @@ def main(conf, filename=None):
                          "Initial configuration", wx.OK).ShowModal()
     else:
         try:
-            frame = MainFrame(conf, engine.AIMaskingEngine(conf))
+            frame = MainFrame(conf,
+                              engine.AIMaskingEngine(conf, load_model=False),
+                              timings)
             def fixgeom():
                 x, y = frame.GetPosition()
                 w, h = frame.GetSize()
@@ -422,6 +1062,8 @@ def main(conf, filename=None):
                 frame.SetSize((w, h))
                 frame.Raise()
                 frame.Show()
+                timings.mark('window shown')
+                frame.load_model()
             wx.CallAfter(fixgeom)
             if filename is not None:
                 wx.CallAfter(lambda : frame.load_image(filename))
@@ -0,0 +1,131 @@
+import sys
+import contextlib
+import traceback
+
+import numpy as np
+
+
+def warn(msg):
+    print(f'warning: {msg}', file=sys.stderr)
+
+
+class InferenceOptions:
+    # the torch options the model runs with. torch is only imported when
+    # some option is actually enabled
+    def __init__(self, conf=None):
+        self.device = 'cpu'
+        self.inference_mode = False
+        self.bf16 = False
+        self.quantize = False
+        self.compile = False
+        if conf is not None:
+            self.device = conf.device.split(':')[0]
+            self.inference_mode = conf.inference_mode
+            self.bf16 = conf.autocast_bf16
+            self.quantize = conf.quantize
+            self.compile = conf.compile_model
+
+    def context(self):
+        if not self.inference_mode and not self.bf16:
+            return contextlib.nullcontext()
+        import torch
+        stack = contextlib.ExitStack()
+        if self.inference_mode:
+            stack.enter_context(torch.inference_mode())
+        if self.bf16:
+            stack.enter_context(torch.autocast(device_type=self.device,
+                                               dtype=torch.bfloat16))
+        return stack
+
+    def key(self):
+        # the options that change the embeddings, for the embedding cache
+        return ''.join(s for (s, on) in (('+bf16', self.bf16),
+                                          ('+int8', self.quantize)) if on)
+
+    def enabled(self):
+        return [name for name in ('inference_mode', 'bf16', 'quantize',
+                                  'compile') if getattr(self, name)]
+
+# end of class InferenceOptions
+
+
+def set_threads(conf):
+    import torch
+    if conf.torch_threads > 0:
+        torch.set_num_threads(conf.torch_threads)
+    if conf.torch_interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(conf.torch_interop_threads)
+        except RuntimeError as e:
+            # it can only be set before any inter-op parallel work
+            warn(f'cannot set the number of inter-op threads: {e}')
+
+
+def bf16_supported(device):
+    import torch
+    if device == 'cuda':
+        return torch.cuda.is_bf16_supported()
+    if device == 'cpu':
+        check = getattr(torch.cpu, '_is_avx512_bf16_supported', None)
+        return check is None or check()
+    return False
+
+
+def self_check(predictor, options):
+    try:
+        img = np.zeros((64, 64, 3), dtype=np.uint8)
+        with options.context():
+            predictor.set_image(img)
+            predictor.predict(point_coords=[[32, 32]], point_labels=[1],
+                              multimask_output=False)
+        return True
+    except Exception:
+        traceback.print_exc()
+        return False
+    finally:
+        predictor.reset_predictor()
+
+
+def setup(model, predictor, conf):
+    # applies the inference options of conf to the model, and returns the
+    # ones that are in effect. The model is checked on a dummy image with
+    # the options that can fail (bf16, quantization, compilation), which
+    # are disabled one at a time, riskiest first, until it works
+    import torch
+    options = InferenceOptions(conf)
+    if options.bf16 and not bf16_supported(options.device):
+        warn(f'bfloat16 is not supported on {conf.device}, disabled')
+        options.bf16 = False
+    if options.quantize and options.device != 'cpu':
+        warn('int8 quantization is only supported on the cpu, disabled')
+        options.quantize = False
+    modules = (model.image_encoder, model.sam_mask_decoder)
+
+    def apply():
+        model.image_encoder, model.sam_mask_decoder = modules
+        if options.quantize:
+            model.image_encoder, model.sam_mask_decoder = [
+                torch.ao.quantization.quantize_dynamic(
+                    m, {torch.nn.Linear}, dtype=torch.qint8)
+                for m in (model.image_encoder, model.sam_mask_decoder)]
+        if options.compile:
+            model.image_encoder = torch.compile(model.image_encoder)
+            model.sam_mask_decoder = torch.compile(model.sam_mask_decoder)
+
+    fallbacks = [name for name in ('compile', 'quantize', 'bf16')
+                 if getattr(options, name)]
+    if not fallbacks:
+        return options
+    while True:
+        try:
+            apply()
+            if self_check(predictor, options):
+                return options
+        except Exception:
+            traceback.print_exc()
+        if not fallbacks:
+            raise RuntimeError('the model does not work with the '
+                               'given inference options')
+        name = fallbacks.pop(0)
+        warn(f'the {name} option does not work here, disabled')
+        setattr(options, name, False)
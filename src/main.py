@@ -1,13 +1,45 @@
+import time
+start_time = time.perf_counter()
+
 import config
-import gui
 import argparse
 import os
+import sys
 
 
 def getopts():
     p = argparse.ArgumentParser()
     p.add_argument('--init-config', action='store_true',
                    help='(re)-create an initial configuration file and exit')
+    p.add_argument('--cache-info', action='store_true',
+                   help='show information about the embedding cache and exit')
+    p.add_argument('--clear-cache', action='store_true',
+                   help='remove all entries from the embedding cache and '
+                   'the checksum index and exit')
+    p.add_argument('--batch', metavar='DIR',
+                   help='regenerate all the masks (*_mask.png files) found in '
+                   'DIR and its subdirectories whose source image or model '
+                   'changed, then exit')
+    p.add_argument('--force', action='store_true',
+                   help='in batch mode, regenerate also up-to-date masks')
+    p.add_argument('-j', '--jobs', type=int,
+                   help='number of parallel workers in batch mode '
+                   '(default: based on the number of cores/devices)')
+    p.add_argument('--sequence', metavar='IMAGE', nargs='+',
+                   help='propagate the masks saved for some of the given '
+                   'images (e.g. the frames of a burst or bracket, in order) '
+                   'to the other ones, then exit')
+    p.add_argument('--serve', metavar='ADDRESS', nargs='?', const='8765',
+                   help='run as a mask server with a JSON API over HTTP, '
+                   'listening on ADDRESS: a port (on localhost, default '
+                   '%(const)s), localhost:PORT or the path of a Unix socket')
+    p.add_argument('--timings', action='store_true',
+                   help='print the time taken to show the window, load the '
+                   'model, load the first image and compute the first mask')
+    p.add_argument('--trace', metavar='FILE',
+                   help='record the time spent in the main operations and '
+                   'save it to FILE on exit, in Chrome trace-event format '
+                   '(viewable in chrome://tracing or Perfetto)')
     p.add_argument('input_file', nargs='?',
                    help='input image')
     return p.parse_args()
@@ -22,8 +54,33 @@ def main():
                  'overwrite (y/N)? ').strip() == 'y':
             conf.save()
             print(f'Configuration saved to: {fn}')
+    elif opts.cache_info or opts.clear_cache:
+        import cache
+        c = cache.EmbeddingCache.from_config(conf)
+        idx = cache.ChecksumIndex.from_config(conf)
+        if opts.clear_cache:
+            n = c.clear()
+            print(f'Removed {n} cache entries')
+            n = idx.clear()
+            print(f'Removed {n} checksum index entries')
+        if opts.cache_info:
+            print(c.info())
+            print(idx.info())
+    elif opts.serve:
+        import server
+        sys.exit(server.main(conf, opts.serve))
+    elif opts.sequence:
+        import sequence
+        sys.exit(sequence.main(conf, opts.sequence))
+    elif opts.batch:
+        import batch
+        sys.exit(batch.main(conf, opts.batch, opts.jobs, opts.force))
     else:
-        gui.main(conf, opts.input_file)
+        import tracing
+        tracing.tracer.configure(opts.trace or conf.trace_file,
+                                 conf.timing_readout)
+        import gui
+        gui.main(conf, opts.input_file, start_time, opts.timings)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,214 @@
+import os
+import sys
+import time
+import threading
+import contextlib
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+import engine
+import inference
+
+
+def mask_file(filename):
+    # the file the GUI saves the mask of an image to by default
+    return os.path.splitext(filename)[0] + '_mask.png'
+
+
+class FrameLoader:
+    # the frames of the sequence as the SAM2 video predictor wants them
+    # (normalized image_size x image_size tensors), decoded from disk when
+    # first needed rather than all at once. Only the last few frames are
+    # kept, and the neighbours of the last requested one are decoded in the
+    # background, so that decoding overlaps with the model
+    mean = (0.485, 0.456, 0.406)
+    std = (0.229, 0.224, 0.225)
+
+    def __init__(self, eng, filenames, image_size, keep=4):
+        self.engine = eng
+        self.filenames = filenames
+        self.image_size = image_size
+        self.keep = keep
+        self.frames = collections.OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def load(self, index):
+        import torch
+        _, img = self.engine.read_image(self.filenames[index])
+        img = Image.fromarray(img).resize((self.image_size, self.image_size),
+                                          Image.BICUBIC)
+        a = torch.from_numpy(np.asarray(img, dtype=np.float32) / 255.0)
+        a = a.permute(2, 0, 1)
+        a -= torch.tensor(self.mean)[:, None, None]
+        a /= torch.tensor(self.std)[:, None, None]
+        return a
+
+    def __getitem__(self, index):
+        with self.lock:
+            frame = self.frames.get(index)
+            if frame is not None:
+                self.frames.move_to_end(index)
+                return frame
+            future = self.pending.pop(index, None)
+        if future is None:
+            frame = self.load(index)
+        else:
+            frame = future.result()
+        with self.lock:
+            self.frames[index] = frame
+            while len(self.frames) > self.keep:
+                self.frames.popitem(last=False)
+            for i in (index + 1, index - 1):
+                if 0 <= i < len(self) and i not in self.frames \
+                   and i not in self.pending:
+                    self.pending[i] = self.executor.submit(self.load, i)
+        return frame
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+# end of class FrameLoader
+
+
+@contextlib.contextmanager
+def _streamed(frames, size):
+    # makes init_state use frames (of size x size) instead of loading all
+    # the video from disk
+    import sam2.sam2_video_predictor as vp
+    load = vp.load_video_frames
+    vp.load_video_frames = lambda **kwargs: (frames, size, size)
+    try:
+        yield
+    finally:
+        vp.load_video_frames = load
+
+
+def build_predictor(conf):
+    from sam2.build_sam import build_sam2_video_predictor
+    import hydra
+    from hydra.core.global_hydra import GlobalHydra
+    if GlobalHydra.instance().is_initialized():
+        GlobalHydra.instance().clear()
+    inference.set_threads(conf)
+    model_cfg_dir, model_cfg = conf.get_model_config()
+    with hydra.initialize(version_base=None, config_path=model_cfg_dir):
+        return build_sam2_video_predictor(model_cfg, conf.get_model_file(),
+                                          device=conf.device)
+
+
+def find_prompts(eng, filenames):
+    # the frames that have a mask made by the user, as a dict from their
+    # index to their layers; masks written by a previous propagation are
+    # not prompts
+    res = {}
+    for i, fn in enumerate(filenames):
+        mf = mask_file(fn)
+        if not os.path.exists(mf):
+            continue
+        info = eng.read_mask_data(mf)
+        if info is None or info.get('propagated') \
+           or os.path.abspath(info['image']) != os.path.abspath(fn) \
+           or eng.checksum(fn) != info['sha256sum']:
+            continue
+        res[i] = [(md.get('layer', eng.default_layer),
+                   md['points'], md['labels'])
+                  for (_, md) in eng.read_layers(mf, info)]
+    return res
+
+
+def main(conf, filenames):
+    eng = engine.AIMaskingEngine(conf, load_model=False)
+    if eng.exiftool is None:
+        print('exiftool is required for sequence mode')
+        return 1
+    filenames = [os.path.abspath(fn) for fn in filenames]
+    prompts = find_prompts(eng, filenames)
+    if not prompts:
+        print('no frame of the sequence has a mask to propagate: make one '
+              'for at least one of them first')
+        return 1
+    names = []
+    for layers in prompts.values():
+        names += [name for (name, _, _) in layers if name not in names]
+    sizes = {}
+    for i in prompts:
+        with Image.open(filenames[i]) as img:
+            sizes[i] = img.size
+    print(f'propagating {len(names)} masks from {len(prompts)} of '
+          f'{len(filenames)} frames')
+
+    predictor = build_predictor(conf)
+    options = inference.InferenceOptions(conf)
+    if options.bf16 and not inference.bf16_supported(options.device):
+        options.bf16 = False
+    # the predictor is told that the frames are as large as the
+    # low-resolution masks, so that it returns those: the full-resolution
+    # masks are computed one strip at a time when saving
+    res = predictor.image_size // 4
+    frames = FrameLoader(eng, filenames, predictor.image_size)
+    with options.context(), _streamed(frames, res):
+        state = predictor.init_state(video_path=filenames,
+                                     offload_video_to_cpu=True)
+    for i, layers in prompts.items():
+        w, h = sizes[i]
+        for name, points, labels in layers:
+            if points:
+                predictor.add_new_points_or_box(
+                    state, frame_idx=i, obj_id=names.index(name),
+                    points=np.array(points, dtype=np.float32) * (res / w,
+                                                                 res / h),
+                    labels=np.array(labels, dtype=np.int32))
+
+    # propagated masks have no points of their own (those of the prompts
+    # are in the coordinates of other frames), and record the frames they
+    # were propagated from instead
+    sources = [filenames[i] for i in sorted(prompts)]
+    done = set(prompts)
+    start = time.perf_counter()
+    total = len(filenames) - len(done)
+    for reverse in (False, True):
+        with options.context():
+            propagation = predictor.propagate_in_video(state, reverse=reverse)
+            for i, obj_ids, logits in propagation:
+                if i in done:
+                    continue
+                done.add(i)
+                fn = filenames[i]
+                with Image.open(fn) as img:
+                    size = img.size
+                logits = dict(zip(obj_ids, logits.float().cpu().numpy()))
+                layers = []
+                for obj_id, name in enumerate(names):
+                    layer = engine.MaskLayer(name)
+                    if obj_id in logits:
+                        layer.mask_input = logits[obj_id]
+                        layer.mask = layer.mask_input[0] > 0
+                    layers.append(layer)
+                mf = mask_file(fn)
+                files = [mf] + [engine.layer_filename(mf, name)
+                                for name in names[1:]]
+                job = engine.SaveJob(
+                    eng, list(zip(layers, files)),
+                    image=(fn, size, (res / size[0], res / size[1])),
+                    data={'propagated': True, 'sources': sources})
+                eng.saver.submit(job)
+                rate = len(done - set(prompts)) / (time.perf_counter() - start)
+                print(f'[{len(done) - len(prompts)}/{total}] {mf}: '
+                      f'propagated, {rate:.2f} frames/s')
+                sys.stdout.flush()
+    frames.close()
+    failed = eng.saver.wait()
+    for job in failed:
+        print(f'{job.items[0][1]}: error: {job.error}')
+    eng.exiftool.close()
+    print(f'propagated the masks to {total} frames in '
+          f'{time.perf_counter() - start:.1f} s')
+    return 1 if failed else 0
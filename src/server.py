@@ -0,0 +1,492 @@
+import io
+import os
+import re
+import sys
+import json
+import stat
+import time
+import base64
+import socket
+import threading
+import traceback
+import collections
+import http.client
+import http.server
+import socketserver
+
+import numpy as np
+from PIL import Image
+
+import config
+import engine
+
+DEFAULT_ADDRESS = '8765'
+LOCALHOST = ('127.0.0.1', 'localhost', '::1')
+
+
+class RequestError(Exception):
+    pass
+
+
+def parse_address(address):
+    # returns (host, port) for TCP, or the path of a Unix socket
+    if os.sep in address or address.endswith('.sock'):
+        return address
+    host, _, port = address.rpartition(':')
+    host = host.strip('[]') or '127.0.0.1'
+    if host not in LOCALHOST:
+        raise ValueError(f'the server can only listen on localhost, '
+                         f'not on {host}')
+    return host, int(port)
+
+
+class Metrics:
+    def __init__(self, size=1000):
+        self.lock = threading.Lock()
+        self.size = size
+        self.latencies = {}
+        self.errors = collections.Counter()
+        self.counters = collections.Counter()
+
+    def record(self, endpoint, elapsed, ok=True):
+        with self.lock:
+            if endpoint not in self.latencies:
+                self.latencies[endpoint] = collections.deque(maxlen=self.size)
+            self.latencies[endpoint].append(elapsed)
+            if not ok:
+                self.errors[endpoint] += 1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def report(self):
+        with self.lock:
+            res = {'counters': dict(self.counters), 'endpoints': {}}
+            for endpoint, lat in self.latencies.items():
+                t = np.array(lat) * 1000
+                res['endpoints'][endpoint] = {
+                    'n': len(t),
+                    'errors': self.errors[endpoint],
+                    'mean_ms': float(t.mean()),
+                    'p50_ms': float(np.percentile(t, 50)),
+                    'p90_ms': float(np.percentile(t, 90)),
+                    'p99_ms': float(np.percentile(t, 99)),
+                    'max_ms': float(t.max()),
+                }
+            return res
+
+# end of class Metrics
+
+
+class MaskRequest:
+    def __init__(self, image, prompts, output=None, png=True):
+        self.image = image
+        self.prompts = prompts
+        self.output = output
+        self.png = png
+        self.submitted = time.perf_counter()
+        self.timings = {}
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    @staticmethod
+    def parse(data, with_prompts=True):
+        if not isinstance(data, dict):
+            raise RequestError('the request must be a JSON object')
+        image = data.get('image')
+        if not isinstance(image, str) or not os.path.isfile(image):
+            raise RequestError(f'image not found: {image}')
+        prompts = []
+        if with_prompts:
+            if 'prompts' in data:
+                prompts = data['prompts']
+            else:
+                prompts = [{'points': data.get('points'),
+                            'labels': data.get('labels')}]
+            if not isinstance(prompts, list) or not prompts:
+                raise RequestError('no prompts given')
+            prompts = [MaskRequest._prompt(p, i) for (i, p)
+                       in enumerate(prompts)]
+        image = os.path.abspath(image)
+        output = data.get('output')
+        if output is not None:
+            output = MaskRequest._output(output, image)
+        return MaskRequest(image, prompts, output,
+                           bool(data.get('png', output is None)))
+
+    @staticmethod
+    def _output(output, image):
+        # masks can only be written next to their source image, as
+        # *_mask.png files (like the GUI does), so that a request cannot
+        # overwrite arbitrary files
+        if not isinstance(output, str) or not output.endswith('_mask.png'):
+            raise RequestError('the output file must be a *_mask.png file')
+        output = os.path.abspath(output)
+        if os.path.dirname(output) != os.path.dirname(image):
+            raise RequestError('the output file must be in the directory '
+                               'of the image')
+        return output
+
+    @staticmethod
+    def _prompt(p, i):
+        try:
+            points = [(float(x), float(y)) for (x, y) in p['points']]
+            labels = [int(l) for l in p['labels']]
+        except (KeyError, TypeError, ValueError):
+            raise RequestError(f'invalid points or labels in prompt {i}')
+        if len(points) != len(labels) or not points \
+           or any(l not in (0, 1) for l in labels):
+            raise RequestError(f'invalid points or labels in prompt {i}')
+        name = p.get('name') or \
+            (engine.AIMaskingEngine.default_layer if i == 0 else f'layer{i+1}')
+        return re.sub(r'[^\w-]+', '_', str(name)), points, labels
+
+# end of class MaskRequest
+
+
+class MaskServer:
+    # all the engine work is done by a single worker thread. Queued
+    # requests for the same image are processed together, so that the
+    # image is decoded and encoded once and their prompts go through the
+    # decoder in a single batch; recently used images and their
+    # embeddings stay in memory (prefetch_memory MB), and on disk in the
+    # embedding cache
+    def __init__(self, conf):
+        self.conf = conf
+        self.engine = engine.AIMaskingEngine(conf, load_model=False)
+        self.metrics = Metrics()
+        self.cond = threading.Condition()
+        self.queue = []
+        self.stamp = None
+        self.thread = None
+
+    def start(self):
+        threading.Thread(target=self.load_model, daemon=True).start()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def load_model(self):
+        try:
+            self.engine.load_model()
+        except Exception:
+            traceback.print_exc()
+
+    def submit(self, request):
+        with self.cond:
+            self.queue.append(request)
+            self.cond.notify_all()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def status(self):
+        eng = self.engine
+        with self.cond:
+            queued = len(self.queue)
+        return {
+            'version': config.version,
+            'model': self.conf.model,
+            'device': self.conf.device,
+            'model_ready': eng.model_ready.is_set() and
+                eng.model_error is None,
+            'model_error': None if eng.model_error is None
+                else str(eng.model_error),
+            'image': eng.image_filename,
+            'queued': queued,
+        }
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                image = self.queue[0].image
+                batch = [r for r in self.queue if r.image == image]
+                self.queue = [r for r in self.queue if r.image != image]
+            start = time.perf_counter()
+            for r in batch:
+                r.timings['queue_ms'] = (start - r.submitted) * 1000
+            try:
+                self.process(image, batch)
+            except Exception as e:
+                traceback.print_exc()
+                for r in batch:
+                    if r.result is None and r.error is None:
+                        r.error = e
+            for r in batch:
+                r.done.set()
+
+    def open(self, image):
+        st = os.stat(image)
+        stamp = (image, st.st_size, st.st_mtime_ns)
+        eng = self.engine
+        if stamp == self.stamp and eng.image is not None:
+            self.metrics.count('image_reused')
+            return
+        self.stamp = None
+        with eng.lock:
+            eng.stash_image()
+            eng.reset(True)
+            if eng.prefetched.get(image) is not None:
+                self.metrics.count('image_memory_hits')
+            else:
+                self.metrics.count('image_loads')
+            eng.open_image(image)
+        self.stamp = stamp
+
+    def process(self, image, batch):
+        eng = self.engine
+        t0 = time.perf_counter()
+        self.open(image)
+        t1 = time.perf_counter()
+        self.metrics.count('batches')
+        self.metrics.count('requests', len(batch))
+        prompts = [p for r in batch for p in r.prompts]
+        if prompts:
+            eng.set_layers(prompts)
+            self.metrics.count('prompts', len(prompts))
+        t2 = time.perf_counter()
+        i = 0
+        for r in batch:
+            r.timings['load_ms'] = (t1 - t0) * 1000
+            r.timings['predict_ms'] = (t2 - t1) * 1000
+            r.timings['batch_size'] = len(batch)
+            layers = eng.layers[i:i+len(r.prompts)]
+            i += len(r.prompts)
+            try:
+                r.result = self.output(r, layers)
+            except Exception as e:
+                r.error = e
+            r.timings['output_ms'] = (time.perf_counter() - t2) * 1000
+
+    def output(self, r, layers):
+        eng = self.engine
+        res = {'image': r.image, 'size': list(eng.size), 'masks': []}
+        files = []
+        if r.output is not None and layers:
+            files = [r.output] + [engine.layer_filename(r.output, l.name)
+                                  for l in layers[1:]]
+            eng.save_layers(list(zip(layers, files)))
+        for j, layer in enumerate(layers):
+            m = {'name': layer.name}
+            if files:
+                m['file'] = files[j]
+            if r.png:
+                mask = engine.full_mask(layer, eng.size, eng.scale)
+                buf = io.BytesIO()
+                Image.fromarray(mask).save(
+                    buf, 'PNG', compress_level=self.conf.png_compress_level)
+                m['png'] = base64.b64encode(buf.getvalue()).decode('ascii')
+            res['masks'].append(m)
+        return res
+
+# end of class MaskServer
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    server_version = 'SMART/' + config.version
+    max_request = 1 << 20
+
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return 'local'
+
+    def check_host(self):
+        # the Host header must be localhost, so that a web page cannot reach
+        # the server through DNS rebinding
+        host = self.headers.get('Host', '')
+        if host.startswith('['):
+            host = host[1:].partition(']')[0]
+        else:
+            host = host.rpartition(':')[0] if ':' in host else host
+        if host in LOCALHOST:
+            return True
+        self.reply(403, {'error': 'invalid Host header'})
+        return False
+
+    def do_GET(self):
+        app = self.server.app
+        if not self.check_host():
+            return
+        if self.path == '/status':
+            self.reply(200, app.status())
+        elif self.path == '/metrics':
+            self.reply(200, app.metrics.report())
+        else:
+            self.reply(404, {'error': f'unknown endpoint {self.path}'})
+
+    def do_POST(self):
+        app = self.server.app
+        if not self.check_host():
+            return
+        if self.path not in ('/load', '/mask'):
+            self.reply(404, {'error': f'unknown endpoint {self.path}'})
+            return
+        # browsers can only send application/json cross-site after a CORS
+        # preflight, which the server never allows
+        ctype = self.headers.get('Content-Type', '').split(';')[0].strip()
+        if ctype.lower() != 'application/json':
+            self.reply(415, {'error': 'the request must be application/json'})
+            return
+        start = time.perf_counter()
+        ok = False
+        try:
+            n = int(self.headers.get('Content-Length', 0))
+            if n > self.max_request:
+                raise RequestError('request too large')
+            data = json.loads(self.rfile.read(n) or b'{}')
+            req = MaskRequest.parse(data, self.path == '/mask')
+            res = app.submit(req)
+            res['timings'] = req.timings
+            res['timings']['total_ms'] = (time.perf_counter() - start) * 1000
+            self.reply(200, res)
+            ok = True
+        except (RequestError, ValueError) as e:
+            self.reply(400, {'error': str(e)})
+        except Exception as e:
+            self.reply(500, {'error': str(e)})
+        finally:
+            app.metrics.record(self.path, time.perf_counter() - start, ok)
+
+    def reply(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+# end of class Handler
+
+
+class TCPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class TCP6Server(TCPServer):
+    address_family = socket.AF_INET6
+
+
+class UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # only a stale socket (e.g. left by a crashed server) is replaced,
+        # never another kind of file
+        try:
+            st = os.lstat(self.server_address)
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(st.st_mode):
+                raise OSError(f'address in use: {self.server_address} '
+                              f'exists and is not a socket')
+            os.remove(self.server_address)
+        super().server_bind()
+        os.chmod(self.server_address, 0o600)
+
+
+def make_server(app, address):
+    addr = parse_address(address)
+    if isinstance(addr, str):
+        httpd = UnixServer(addr, Handler)
+    elif ':' in addr[0]:
+        httpd = TCP6Server(addr, Handler)
+    else:
+        httpd = TCPServer(addr, Handler)
+    httpd.app = app
+    return httpd
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+# end of class UnixHTTPConnection
+
+
+class Client:
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=600):
+        self.address = parse_address(address)
+        self.timeout = timeout
+
+    def request(self, method, path, data=None):
+        if isinstance(self.address, str):
+            conn = UnixHTTPConnection(self.address, self.timeout)
+        else:
+            conn = http.client.HTTPConnection(*self.address,
+                                              timeout=self.timeout)
+        try:
+            body = None if data is None else json.dumps(data)
+            conn.request(method, path, body,
+                         {'Content-Type': 'application/json'})
+            resp = conn.getresponse()
+            res = json.loads(resp.read())
+            if resp.status != 200:
+                raise RequestError(res.get('error', resp.reason))
+            return res
+        finally:
+            conn.close()
+
+    def status(self):
+        return self.request('GET', '/status')
+
+    def metrics(self):
+        return self.request('GET', '/metrics')
+
+    def load(self, image):
+        return self.request('POST', '/load', {'image': image})
+
+    def mask(self, image, points=None, labels=None, prompts=None,
+             output=None, png=None):
+        data = {'image': image}
+        if prompts is not None:
+            data['prompts'] = prompts
+        else:
+            data['points'] = points
+            data['labels'] = labels
+        if output is not None:
+            data['output'] = output
+        if png is not None:
+            data['png'] = png
+        return self.request('POST', '/mask', data)
+
+    @staticmethod
+    def decode_mask(mask):
+        data = base64.b64decode(mask['png'])
+        return np.array(Image.open(io.BytesIO(data)))
+
+# end of class Client
+
+
+def main(conf, address=DEFAULT_ADDRESS):
+    app = MaskServer(conf)
+    try:
+        httpd = make_server(app, address)
+    except (ValueError, OSError) as e:
+        print(f'cannot start the server: {e}')
+        return 1
+    app.start()
+    print(f'serving on {address}', file=sys.stderr)
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        if isinstance(httpd.server_address, str):
+            try:
+                os.remove(httpd.server_address)
+            except OSError:
+                pass
+    return 0
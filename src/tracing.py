@@ -0,0 +1,111 @@
+import os
+import json
+import time
+import atexit
+import threading
+import collections
+import contextlib
+
+
+class Span:
+    __slots__ = ('tracer', 'name', 'start', 'children')
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+        self.children = []
+
+    def __enter__(self):
+        self.tracer._stack().append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        end = time.perf_counter()
+        stack = self.tracer._stack()
+        stack.pop()
+        if stack:
+            stack[-1].children.append((self.name, end - self.start))
+        self.tracer._finished(self, end, not stack)
+
+# end of class Span
+
+
+class Tracer:
+    max_events = 1000000
+
+    def __init__(self):
+        self.filename = None
+        self.readout = False
+        self.active = False
+        self.listeners = []
+        self.last = None
+        self.events = collections.deque(maxlen=self.max_events)
+        self.threads = {}
+        self.origin = time.perf_counter()
+        self.local = threading.local()
+        self.null = contextlib.nullcontext()
+
+    def configure(self, filename=None, readout=False):
+        if filename and not self.filename:
+            atexit.register(self.save)
+        self.filename = filename
+        self.readout = readout
+        self.active = bool(filename or readout)
+
+    def span(self, name):
+        if not self.active:
+            return self.null
+        return Span(self, name)
+
+    def _stack(self):
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    def _finished(self, span, end, toplevel):
+        if self.filename:
+            tid = threading.get_native_id()
+            if tid not in self.threads:
+                self.threads[tid] = threading.current_thread().name
+            self.events.append((span.name, span.start, end, tid))
+        if toplevel:
+            self.last = (span.name, end - span.start, span.children)
+            for func in self.listeners:
+                func(*self.last)
+
+    def add_listener(self, func):
+        self.listeners.append(func)
+
+    @staticmethod
+    def format(name, duration, children):
+        res = f'{name}: {duration * 1000:.0f} ms'
+        if children:
+            res += ' (' + ', '.join(f'{n} {d * 1000:.0f}'
+                                    for (n, d) in children) + ')'
+        return res
+
+    def save(self, filename=None):
+        if filename is None:
+            filename = self.filename
+        if not filename:
+            return
+        pid = os.getpid()
+        us = lambda t: (t - self.origin) * 1e6
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                   'args': {'name': name}}
+                  for (tid, name) in list(self.threads.items())]
+        for (name, start, end, tid) in list(self.events):
+            events.append({'name': name, 'cat': 'smart', 'ph': 'X',
+                           'ts': us(start), 'dur': us(end) - us(start),
+                           'pid': pid, 'tid': tid})
+        with open(filename, 'w') as out:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, out)
+
+# end of class Tracer
+
+
+tracer = Tracer()
+span = tracer.span